@@ -0,0 +1,145 @@
+import random
+import re
+import threading
+import time
+
+# HTTP codes worth another attempt; 429 additionally shrinks the concurrency
+THROTTLED_CODES = {429}
+TRANSIENT_CODES = {408, 500, 502, 503, 504}
+TRANSIENT_NAMES = ("Timeout", "Connect", "RemoteProtocol", "ReadError")
+
+
+def error_code(error):
+    for attr in ("code", "status_code"):
+        code = getattr(error, attr, None)
+        if isinstance(code, int):
+            return code
+    response = getattr(error, "response", None)
+    code = getattr(response, "status_code", None)
+    return code if isinstance(code, int) else None
+
+
+# "throttled", "transient" or "fatal"
+def classify(error):
+    code = error_code(error)
+    if code in THROTTLED_CODES:
+        return "throttled"
+    if code in TRANSIENT_CODES:
+        return "transient"
+    if code is None and (isinstance(error, (ConnectionError, TimeoutError))
+                         or any(name in type(error).__name__ for name in TRANSIENT_NAMES)):
+        return "transient"
+    return "fatal"
+
+
+def find_retry_delay(details):
+    if isinstance(details, dict):
+        for key, value in details.items():
+            if key == "retryDelay":
+                return value
+            found = find_retry_delay(value)
+            if found:
+                return found
+    elif isinstance(details, list):
+        for value in details:
+            found = find_retry_delay(value)
+            if found:
+                return found
+    return None
+
+
+# seconds the server asked to wait: the Retry-After header or google.rpc.RetryInfo
+def retry_after(error):
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    if value is None:
+        value = find_retry_delay(getattr(error, "details", None))
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)s?\s*", str(value)) if value is not None else None
+    return float(match.group(1)) if match else None
+
+
+# additive increase / multiplicative decrease of the number of requests in
+# flight: +1 after a full window of successes, halved on a 429; throttles of
+# requests started before the last decrease don't halve it again
+class AimdController:
+    def __init__(self, max_limit, start=None, min_limit=1):
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.limit = min(self.max_limit, start or self.max_limit)
+        self.in_flight = 0
+        self._successes = 0
+        self._epoch = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+            return self._epoch
+
+    def release(self, epoch, throttled=False):
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self._successes = 0
+                if epoch == self._epoch:
+                    self.limit = max(self.min_limit, self.limit // 2)
+                    self._epoch += 1
+            else:
+                self._successes += 1
+                if self._successes >= self.limit and self.limit < self.max_limit:
+                    self.limit += 1
+                    self._successes = 0
+            self._cond.notify_all()
+
+
+class RetryingModels:
+    def __init__(self, client):
+        self._client = client
+
+    def generate_content(self, **kwargs):
+        retrying = self._client
+        attempt = 0
+        while True:
+            epoch = retrying.controller.acquire() if retrying.controller else None
+            outcome = "ok"
+            try:
+                return retrying.client.models.generate_content(**kwargs)
+            except Exception as e:
+                outcome = classify(e)
+                attempt += 1
+                if outcome == "fatal" or attempt > retrying.max_retries:
+                    raise
+                error = e
+            finally:
+                if retrying.controller:
+                    retrying.controller.release(epoch, outcome == "throttled")
+
+            # full jitter, unless the server said how long to wait
+            delay = retry_after(error)
+            if delay is None:
+                delay = random.uniform(0, min(retrying.max_delay, retrying.base_delay * 2 ** (attempt - 1)))
+            print(f"Ошибка API ({error_code(error) or type(error).__name__}), попытка {attempt + 1} "
+                  f"через {delay:.1f} с.")
+            retrying.sleep(min(delay, retrying.max_delay))
+            if retrying.limiter:
+                retrying.limiter.acquire()
+
+
+# wraps a genai.Client (or FakeClient): transient errors are retried with
+# backoff, 429s also shrink the AIMD concurrency window
+class RetryingClient:
+    def __init__(self, client, controller=None, limiter=None, max_retries=5, base_delay=1.0, max_delay=60.0,
+                 sleep=time.sleep):
+        self.client = client
+        self.controller = controller
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self.models = RetryingModels(self)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
@@ -1,22 +1,21 @@
-from google import genai
-from markitdown import MarkItDown  # type: ignore
-import openpyxl
-from openpyxl.styles import Border, Side, Alignment, Border
 import re
 import argparse
 import os
-import json
-import fitz
-
-#init parser and model
-md = MarkItDown()
+from ResponseCache import ResponseCache
+from TextExtract import BACKENDS, extract_text
+from PageSelect import pages_option, select_pages
+from InvoiceRegister import InvoiceRegister
+from SpravkaRenderer import write_data_to_excel
+from Metrics import MetricsLog, timed
+from InvoiceSchema import Invoice, request_invoice
+from ApiRetry import RetryingClient
+from ContextCache import ContextCache
+import LocalExtract
+
+#init model
 model = 'gemini-2.0-flash'
 
-#init border style
-thin_border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
-
-def analyze_invoice(invoice_text, client):
-    prompt = """
+PROMPT = """
     Ты - опытный бухгалтер, специализирующийся на анализе счетов на оказание услуг.
     Твоя задача - извлечь из предоставленного текста счета ключевую информацию и
     представить её в структурированном JSON формате.
@@ -95,21 +94,49 @@ def analyze_invoice(invoice_text, client):
         }
         ```
     Текст счета:
-    """ + invoice_text
+    """
+
+# the part of the prompt that is the same for every invoice
+PROMPT_PREFIX = PROMPT.rsplit("Текст счета:", 1)[0]
+
+def analyze_invoice(invoice_text, client, cache=None, metrics=None, limiter=None, prefill=True, context=None):
+    prompt = PROMPT
+
+    # regular fields are taken from the text, the model only gets the rest
+    local = None
+    if prefill:
+        with timed(metrics, "prefill"):
+            local = LocalExtract.scan(invoice_text)
+            if local.complete():
+                if metrics: metrics.parse_path = "local"
+                return Invoice.from_dict(local.to_dict()).to_dict()
+            prompt = PROMPT_PREFIX + local.prompt_note() + "    Текст счета:\n    "
+            invoice_text = local.trim(invoice_text)
+
+    if metrics: metrics.payload_bytes = len(invoice_text.encode("utf-8"))
+
+    cache_key = None
+    if cache:
+        cache_key = cache.key(model, prompt + invoice_text, [])
+        cached = cache.get(cache_key)
+        if cached is not None:
+            if metrics: metrics.parse_path = "cache"
+            return cached
 
     #analyze document and return result as json
+    parse_path = "failed"
     try:
-        response = client.models.generate_content(model=model, contents=[prompt])
-        json_text = response.text
-        try:
-             return json.loads(json_text)
-        except json.JSONDecodeError:
-            json_text = re.sub(r'```json\n?|```', '', json_text).strip()
-            try: return json.loads(json_text)
-            except: return json.loads(json_text.replace("'", '"'))
+        result, parse_path = request_invoice(client, model, prompt, [invoice_text], metrics, limiter,
+                                             (len(prompt) + len(invoice_text)) // 4, local, context)
     except Exception as e:
+        if metrics: metrics.parse_path = parse_path; metrics.error = str(e)
         return f"Error: {e}"
 
+    if metrics: metrics.parse_path = parse_path
+
+    if cache_key: cache.put(cache_key, result)
+    return result
+
 def extract_data_from_analysis(analysis_result):
     data = {}
     if isinstance(analysis_result, str):
@@ -142,173 +169,106 @@ def extract_data_from_analysis(analysis_result):
     data["services"] = analysis_result.get("service_details", [])
     return data
 
-def write_data_to_excel(data, excel_file="output.xlsx"):
-    if os.path.exists(excel_file):
-        os.remove(excel_file)
-
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = "Sheet1"
-
-    #write data
-    ws.cell(row=2, column=2).value = "Бухгалтерская справка № Б.Н."
-    ws.cell(row=2, column=4).value = "от " + data.get("document_date", "")
-    ws.cell(row=3, column=2).value = data.get("contract_info", "")
-    ws.cell(row=5, column=1).value = "Исполнитель"
-    ws.cell(row=5, column=2).value = data.get("Исполнитель_Компания", "")
-    executor_details = f'{data.get("Исполнитель_УНП", "")}, {data.get("Исполнитель_Адрес", "")}'
-    ws.cell(row=6, column=1).value = executor_details
-    ws.cell(row=7, column=1).value = 'Расчетный счет ' + data.get("Исполнитель_Расчетный_счет", "")
-    ws.cell(row=8, column=1).value = "в " + data.get("Исполнитель_Банк", "")
-    ws.cell(row=10, column=1).value = "Заказчик"
-    client_details = f'{data.get("Заказчик_Компания", "")}, {data.get("Заказчик_Адрес", "")}'
-    ws.cell(row=10, column=2).value = client_details
-    ws.cell(row=12, column=3).value = "За период " + data.get("За период", "") + " оказаны услуги"
-
-    #Table Data
-    table_start_row = 15
-    ws.merge_cells(start_row=table_start_row - 1, start_column=2, end_row=table_start_row - 1, end_column=5)
-    ws.cell(row=table_start_row - 1, column=2).value = "Сумма оказанных услуг"
-    ws.cell(row=table_start_row - 1, column=2).alignment = Alignment(horizontal='center')
-    ws.cell(row=table_start_row - 1, column=2).border = thin_border
-    ws.merge_cells(start_row=table_start_row - 1, start_column=1, end_row=table_start_row, end_column=1)
-    ws.cell(row=table_start_row - 1, column=1).value = "Наименование услуги"
-    ws.cell(row=table_start_row - 1, column=1).alignment = Alignment(horizontal='center', vertical='center')
-    ws.cell(row=table_start_row - 1, column=1).border = thin_border
-
-    #write table headers
-    table_header = ["Сумма без НДС, руб.", "Ставка НДС", "Сумма НДС, руб.", "Сумма с НДС, руб."]
-    for col_num, header in enumerate(table_header, start=2):
-        cell = ws.cell(row=table_start_row, column=col_num)
-        cell.value = header
-        cell.border = thin_border; cell.alignment = Alignment(horizontal='center')
-
-    row_num = table_start_row + 1
-    total_without_vat = 0
-    total_vat_amount = 0
-    total_with_vat = 0
-
-    #write table data
-    for service in data.get("services", []):
-        service_name_cell = ws.cell(row=row_num, column=1)
-        service_name_cell.value = service.get("service_name", "")
-        service_name_cell.alignment = Alignment(wrap_text=True, vertical='top')
-        ws.cell(row=row_num, column=2).value = service.get("amount_without_vat", "")
-        ws.cell(row=row_num, column=3).value = service.get("vat_rate", "")
-        ws.cell(row=row_num, column=4).value = service.get("vat_amount", "")
-        ws.cell(row=row_num, column=5).value = service.get("amount_with_vat", "")
-
-        #calculate totals
-        try:
-            total_without_vat += float(service.get("amount_without_vat", "0").replace(",", "."))
-        except ValueError: pass
-        try:
-            vat_amount_str = service.get("vat_amount", "0").replace(",", ".")
-            if vat_amount_str != "-":
-                total_vat_amount += float(vat_amount_str)
-        except ValueError: pass
-        try:
-            total_with_vat += float(service.get("amount_with_vat", "0").replace(",", "."))
-        except ValueError: pass
-        row_num += 1
-
-    ws.cell(row=row_num, column=1).value = "Итого"
-    ws.cell(row=row_num, column=2).value = str(total_without_vat).replace(".", ",")
-    ws.cell(row=row_num, column=3).value = service.get("vat_rate", "") if total_without_vat > 0 else "-"
-    ws.cell(row=row_num, column=4).value = str(total_vat_amount).replace(".", ",") if total_vat_amount > 0 else "-"
-    ws.cell(row=row_num, column=5).value = str(total_with_vat).replace(".", ",")
-
-    for row in ws[table_start_row - 1:row_num]:
-        for cell in row:
-            cell.border = thin_border
-            if cell.row > table_start_row and cell.column > 1:
-                cell.alignment = Alignment(horizontal='right')
-
-    #Shifting data after the table
-    data_start_row = row_num + 2
-
-    ws.cell(row=data_start_row, column=1).value = "Стоимость оказанных услуг: " + data.get("Общая стоимость услуг", "")
-    ws.cell(row=data_start_row + 1, column=1).value = data.get("НДС_Статус", "")
-    ws.cell(row=data_start_row + 3, column=1).value = "Документ составлен в единоличном порядке в соответствии с п.1.7. Договора, на основании п. 1 "
-    ws.cell(row=data_start_row + 4, column=1).value = "Постановления Министерства Финансов Республики Беларусь от 12.02.2018 № 13"
-    ws.cell(row=data_start_row + 6, column=1).value = "Основание: " + data.get("document_number", "") + " от " + data.get("document_date", "")
-    ws.cell(row=data_start_row + 9, column=1).value = f"{data.get('Директор_Должность', '')} {data.get('Заказчик_Компания', '')}"
-    ws.cell(row=data_start_row + 9, column=5).value = data.get("Директор_ФИО", "")
-    ws.cell(row=data_start_row + 9, column=3).border = Border(bottom=Side(style='thin'))
-
-    #set column widths
-    column_widths = {'A': 22, 'B': 15, 'C': 15, 'D': 15, 'E': 15}
-    for col, width in column_widths.items():
-        ws.column_dimensions[col].width = width + 1
-
-    wb.save(excel_file)
-    print(f"Data written to {excel_file}")
-
 def main():
     parser = argparse.ArgumentParser(description="Analyze an invoice and extract data to an Excel file.")
 
     parser.add_argument("-i", "--input", required=True, help="Path to the input PDF file.")
     parser.add_argument("-k", "--key", required=True, help="Your Google Gemini API key.")
+    parser.add_argument("-p", "--pages", type=pages_option, default="auto", help="Pages sent to the model: auto (header, requisites and ИТОГО pages), all, N leading pages or ask.")
+    parser.add_argument("--extractor", choices=sorted(BACKENDS), default="fitz", help="Text extraction backend.")
+    parser.add_argument("--output", choices=["spravka", "register", "both"], default="spravka", help="spravka - the accounting note workbook, register - a row in a register workbook.")
+    parser.add_argument("--register", default="invoice_register.xlsx", help="Path of the register workbook; each run adds a row to it.")
+    parser.add_argument("--template", default=None, help="Template workbook of the справка (default: templates/spravka.xlsx).")
+    parser.add_argument("--metrics", default=None, help="Append timings, payload size and token usage to this JSONL file.")
+    parser.add_argument("--no-prefill", action="store_true", help="Send every field to the model, skip the local regex extraction.")
+    parser.add_argument("--context-cache", action="store_true",
+                        help="Cache the instruction block on the Gemini side (pays off for repeated calls only).")
+    parser.add_argument("--max-retries", type=int, default=5, help="Retries of a request after 429/5xx and network errors.")
+    parser.add_argument("--cache-dir", default=".gemini_cache", help="Directory of the model response cache.")
+    parser.add_argument("--no-cache", action="store_true", help="Don't read or write cached model responses.")
+    parser.add_argument("--refresh", action="store_true", help="Ignore cached responses and overwrite them with fresh ones.")
 
     args = parser.parse_args()
 
-    client = genai.Client(api_key=args.key)
+    # heavy dependencies are imported only after the arguments are parsed
+    import fitz
+    from google import genai
+
+    client = RetryingClient(genai.Client(api_key=args.key), max_retries=args.max_retries)
+    cache = None if args.no_cache else ResponseCache(args.cache_dir, refresh=args.refresh)
+    metrics_log = MetricsLog(args.metrics) if args.metrics else None
+    metrics = metrics_log.document(args.input) if metrics_log else None
 
     if not os.path.exists(args.input):
         print(f"Error: Input file '{args.input}' not found.")
         return
 
     # Открываем PDF
-    doc = fitz.open(args.input)
+    with timed(metrics, "open"):
+        doc = fitz.open(args.input)
     total_pages = len(doc)
 
     print(f"Оригинальный PDF содержит {total_pages} страниц.")
 
-    while True:
-        try:
-            num_pages = int(input(f"Сколько страниц оставить? (0 - оставить все, 1-{total_pages}): "))
-            if 0 <= num_pages <= total_pages:
-                break
-            else:
-                print("Ошибка: число вне диапазона.")
-        except ValueError:
-            print("Ошибка: введите целое число.")
-
-    if num_pages == 0:
-        print("Используется оригинальный PDF без изменений.")
-        pdf_to_process = args.input
-    else:
-        # Создаём временный PDF
-        temp_pdf = "temp.pdf"
-        new_doc = fitz.open()
-
-        for page_num in range(num_pages):
-            new_doc.insert_pdf(doc, from_page=page_num, to_page=page_num)
-
-        new_doc.save(temp_pdf)
-        new_doc.close()
-        pdf_to_process = temp_pdf
-        print(f"Создан временный PDF: {temp_pdf}")
-
+    pages = args.pages
+    if pages == "ask":
+        while True:
+            try:
+                num_pages = int(input(f"Сколько страниц оставить? (0 - оставить все, 1-{total_pages}): "))
+                if 0 <= num_pages <= total_pages:
+                    break
+                else:
+                    print("Ошибка: число вне диапазона.")
+            except ValueError:
+                print("Ошибка: введите целое число.")
+
+        if num_pages == 0:
+            print("Используется оригинальный PDF без изменений.")
+        pages = str(num_pages)
+
+    with timed(metrics, "select"):
+        page_numbers = select_pages(doc, pages)
+    print(f"Страницы для анализа: {', '.join(str(n + 1) for n in page_numbers)}")
+
+    # Извлекаем текст прямо из открытого PDF, без временных файлов
+    with timed(metrics, "extract_text"):
+        invoice_text = extract_text(doc, page_numbers, args.extractor)
     doc.close()
+    if metrics: metrics.pages = len(page_numbers)
 
-    # Обрабатываем PDF (оригинальный или временный)
-    result = md.convert(pdf_to_process)
-
-    analysis_result = analyze_invoice(result.text_content, client)
+    context = ContextCache(client, model, PROMPT_PREFIX) if args.context_cache else None
+    analysis_result = analyze_invoice(invoice_text, client, cache, metrics, prefill=not args.no_prefill, context=context)
+    if context:
+        context.close()
     print("\nРезультат анализа:")
     print(analysis_result)
+    if isinstance(analysis_result, str):
+        # a failed request must not turn into an empty справка
+        if metrics:
+            metrics.finish()
+            metrics_log.print_summary()
+        return
+
+    with timed(metrics, "extract"):
+        extracted_data = extract_data_from_analysis(analysis_result)
 
-    extracted_data = extract_data_from_analysis(analysis_result)
+    with timed(metrics, "write"):
+        if args.output != "spravka":
+            # one file per run, so the register grows across runs
+            register = InvoiceRegister(args.register, append=True)
+            register.add(os.path.basename(args.input), extracted_data)
+            register.close()
 
-    base_name = os.path.splitext(args.input)[0]
-    output_file = f"{base_name}.xlsx"
+        if args.output != "register":
+            base_name = os.path.splitext(args.input)[0]
+            output_file = f"{base_name}.xlsx"
 
-    write_data_to_excel(extracted_data, output_file)
+            write_data_to_excel(extracted_data, output_file, args.template)
 
-    if num_pages != 0:
-        os.remove(temp_pdf)
-        print(f"Временный PDF {temp_pdf} удалён.")
+    if metrics:
+        metrics.record_data(extracted_data)
+        metrics.finish()
+        metrics_log.print_summary()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# stages a document goes through; only "done" is skipped on the next run,
+# "analyzed" keeps the model answer so a restart doesn't pay for it again
+STAGES = ("queued", "rendered", "analyzed", "done", "failed")
+
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# SQLite journal of a batch run keyed by the sha256 of the PDF content, so
+# renamed files are recognized and changed ones are processed again
+class BatchJournal:
+    def __init__(self, journal_file):
+        self.journal_file = journal_file
+        self._lock = threading.Lock()
+        self._hashes = {}  # path -> content hash of the current run
+        self._db = sqlite3.connect(journal_file, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS documents (
+            hash TEXT PRIMARY KEY, path TEXT, size INTEGER, mtime_ns INTEGER, stage TEXT,
+            output TEXT, result TEXT, data TEXT, error TEXT, updated TEXT)""")
+        # journals written before the bulk export have no exported column
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(documents)")]
+        if "exported" not in columns:
+            self._db.execute("ALTER TABLE documents ADD COLUMN exported INTEGER DEFAULT 0")
+        self._db.execute("CREATE INDEX IF NOT EXISTS documents_path ON documents (path)")
+        self._db.commit()
+
+    # the content hash, reusing the stored one while size and mtime are unchanged
+    def content_hash(self, pdf_file):
+        stat = os.stat(pdf_file)
+        with self._lock:
+            row = self._db.execute("SELECT hash FROM documents WHERE path = ? AND size = ? AND mtime_ns = ?",
+                                   (pdf_file, stat.st_size, stat.st_mtime_ns)).fetchone()
+        content_hash = row[0] if row else file_hash(pdf_file)
+        self._hashes[pdf_file] = content_hash
+        return content_hash
+
+    def lookup(self, content_hash):
+        with self._lock:
+            row = self._db.execute("SELECT path, stage, output, result, data, exported FROM documents WHERE hash = ?",
+                                   (content_hash,)).fetchone()
+        if not row:
+            return None
+        path, stage, output, result, data, exported = row
+        return {"path": path, "stage": stage, "output": output,
+                "result": json.loads(result) if result else None,
+                "data": json.loads(data) if data else None,
+                "exported": bool(exported)}
+
+    def start(self, pdf_file, output_file):
+        stat = os.stat(pdf_file)
+        with self._lock:
+            self._db.execute("""INSERT INTO documents (hash, path, size, mtime_ns, stage, output, updated)
+                VALUES (?, ?, ?, ?, 'queued', ?, ?)
+                ON CONFLICT (hash) DO UPDATE SET path = excluded.path, size = excluded.size,
+                    mtime_ns = excluded.mtime_ns, stage = 'queued', output = excluded.output,
+                    error = '', exported = 0, updated = excluded.updated""",
+                             (self._hashes[pdf_file], pdf_file, stat.st_size, stat.st_mtime_ns, output_file,
+                              time.strftime("%Y-%m-%dT%H:%M:%S")))
+            self._db.commit()
+
+    def update(self, pdf_file, stage, result=None, data=None, error=""):
+        content_hash = self._hashes.get(pdf_file)
+        if content_hash is None:
+            return
+        with self._lock:
+            self._db.execute("""UPDATE documents SET stage = ?, result = COALESCE(?, result),
+                data = COALESCE(?, data), error = ?, updated = ? WHERE hash = ?""",
+                             (stage, json.dumps(result, ensure_ascii=False) if result is not None else None,
+                              json.dumps(data, ensure_ascii=False) if data is not None else None,
+                              error, time.strftime("%Y-%m-%dT%H:%M:%S"), content_hash))
+            self._db.commit()
+
+    # called by BulkExport once the rows of these files are on disk; a "done"
+    # document without the flag is exported again when the next run skips it
+    def mark_exported(self, pdf_files):
+        hashes = [(self._hashes[pdf_file],) for pdf_file in pdf_files if pdf_file in self._hashes]
+        if not hashes:
+            return
+        with self._lock:
+            self._db.executemany("UPDATE documents SET exported = 1 WHERE hash = ?", hashes)
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,256 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import BaseGemini
+import ThinkingGemini
+from FakeGemini import FakeClient
+from Metrics import DocumentMetrics
+from PageRender import RenderProfile, render_pages
+from PageSelect import select_pages
+from TextExtract import extract_text
+
+STAGES = ["open", "select", "extract_text", "rasterize", "prefill", "request_build", "api", "parse", "extract", "write"]
+
+EXECUTORS = [
+    ("ООО 'СофтСервис'", "г. Гродно, ул. Ленина, 5/2", "500484719", "BY22 BELB 3012 1401 7701 1022 6000", "ОАО 'БАНК БЕЛВЭБ' BELBBY2X"),
+    ("РУП 'Белтелеком'", "г. Минск, ул. Энгельса, 6", "100289066", "BY64 AKBB 3012 0000 0418 0000 0000", "ОАО 'АСБ Беларусбанк' AKBBBY2X"),
+    ("ООО 'Хостинг Бай'", "г. Минск, пр. Независимости, 95", "192345678", "BY13 ALFA 3012 2345 6700 1027 0000", "ЗАО 'Альфа-Банк' ALFABY2X"),
+]
+
+SERVICES = ["Услуги связи", "Хостинг", "Сопровождение программного обеспечения", "Аренда сервера", "Техническая поддержка"]
+
+
+# synthetic Belarusian service invoice; the first page has the header,
+# requisites and the ИТОГО table, the rest are call/usage detail pages
+def make_invoice(pdf_file, pages, scanned, rng):
+    import fitz
+    font = fitz.Font("cjk")  # builtin font with Cyrillic glyphs
+
+    executor = rng.choice(EXECUTORS)
+    number = rng.randint(100, 9999)
+    amount = rng.randint(50, 5000) + rng.randint(0, 99) / 100
+    vat = round(amount * 0.2, 2)
+
+    doc = fitz.open()
+    for page_num in range(pages):
+        page = doc.new_page()
+        writer = fitz.TextWriter(page.rect)
+        y = 60
+
+        def line(text, x=40, size=9):
+            nonlocal y
+            writer.append((x, y), text, font=font, fontsize=size)
+            y += size + 5
+
+        if page_num == 0:
+            line(f"Счет № {number} от 31.12.2024", size=12)
+            line(f"по договору № ПО-{rng.randint(10, 999)} от 01.09.2019")
+            y += 10
+            line(f"Исполнитель: {executor[0]}")
+            line(f"Адрес: {executor[1]}")
+            line(f"УНП {executor[2]}")
+            line(f"Р/с {executor[3]} в {executor[4]}")
+            y += 10
+            line("Заказчик: ООО 'ДЕВКРАФТ'")
+            line("Адрес: г. Гродно, ул. Мостовая, 31, УНП 591007097")
+            line("Период: с 01.12.2024 по 31.12.2024")
+            y += 10
+            for x, header in zip((40, 260, 340, 420, 500), ("Наименование услуги", "Сумма без НДС", "Ставка НДС", "Сумма НДС", "Сумма с НДС")):
+                writer.append((x, y), header, font=font, fontsize=9)
+            y += 14
+            service = rng.choice(SERVICES)
+            for x, value in zip((40, 260, 340, 420, 500), (service, f"{amount:.2f}", "20%", f"{vat:.2f}", f"{amount + vat:.2f}")):
+                writer.append((x, y), value.replace(".", ","), font=font, fontsize=9)
+            y += 14
+            for x, value in zip((40, 260, 420, 500), ("ИТОГО", f"{amount:.2f}", f"{vat:.2f}", f"{amount + vat:.2f}")):
+                writer.append((x, y), value.replace(".", ","), font=font, fontsize=9)
+            y += 30
+            line("Директор ____________ А.В.Иванов")
+        else:
+            line(f"Детализация счета № {number}, лист {page_num + 1}", size=11)
+            while y < page.rect.height - 60:
+                line(f"{rng.randint(1, 31):02d}.12.2024  +375 29 {rng.randint(1000000, 9999999)}  "
+                     f"{rng.randint(1, 60)} мин  {rng.randint(0, 500) / 100:.2f}".replace(".", ",", 1), size=8)
+        writer.write_text(page)
+
+    if scanned:
+        # keep only a raster of each page, like a scanner would produce
+        scan = fitz.open()
+        for page in doc:
+            pix = page.get_pixmap(dpi=150, colorspace=fitz.csGRAY)
+            scan.new_page(width=page.rect.width, height=page.rect.height).insert_image(page.rect, pixmap=pix)
+        doc.close()
+        doc = scan
+
+    doc.save(pdf_file)
+    doc.close()
+
+
+class StageTimer:
+    def __init__(self):
+        self.times = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        yield
+        self.times[name] = self.times.get(name, 0) + (time.perf_counter() - start) * 1000
+
+
+# prefill/api/parse come from the stages the pipeline records itself, which
+# cover a re-ask as well as no call at all; the rest of the time is request_build
+def timed_analyze(timer, analyze, payload, client):
+    metrics = DocumentMetrics(None)
+    start = time.perf_counter()
+    result = analyze(payload, client, metrics=metrics)
+    elapsed = (time.perf_counter() - start) * 1000
+    for name, ms in metrics.stages.items():
+        timer.times[name] = timer.times.get(name, 0) + ms
+    timer.times["request_build"] = elapsed - sum(metrics.stages.values())
+    return result
+
+
+def run_base(pdf_file, client, out_dir, extractor, pages):
+    import fitz
+    timer = StageTimer()
+    with timer.stage("open"):
+        doc = fitz.open(pdf_file)
+    with timer.stage("select"):
+        page_numbers = select_pages(doc, pages)
+    with timer.stage("extract_text"):
+        invoice_text = extract_text(doc, page_numbers, extractor)
+    doc.close()
+    analysis_result = timed_analyze(timer, BaseGemini.analyze_invoice, invoice_text, client)
+    with timer.stage("extract"):
+        data = BaseGemini.extract_data_from_analysis(analysis_result)
+    with timer.stage("write"), contextlib.redirect_stdout(io.StringIO()):
+        BaseGemini.write_data_to_excel(data, os.path.join(out_dir, "base.xlsx"))
+    return timer.times
+
+
+def run_thinking(pdf_file, client, out_dir, profile, pages):
+    import fitz
+    timer = StageTimer()
+    with timer.stage("open"):
+        doc = fitz.open(pdf_file)
+    with timer.stage("select"):
+        page_numbers = select_pages(doc, pages)
+    doc.close()
+    with timer.stage("rasterize"):
+        image_data, _, _ = render_pages(pdf_file, page_numbers, profile)
+    analysis_result = timed_analyze(timer, ThinkingGemini.analyze_invoice, image_data, client)
+    with timer.stage("extract"):
+        data = ThinkingGemini.extract_data_from_analysis(analysis_result)
+    with timer.stage("write"), contextlib.redirect_stdout(io.StringIO()):
+        ThinkingGemini.write_data_to_excel(data, os.path.join(out_dir, "thinking.xlsx"))
+    return timer.times
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def summarize(samples):
+    summary = {}
+    for stage in STAGES + ["total"]:
+        values = [s[stage] for s in samples if stage in s]
+        if values:
+            summary[stage] = {"median_ms": round(statistics.median(values), 3),
+                              "p95_ms": round(percentile(values, 0.95), 3)}
+    return summary
+
+
+def print_report(results):
+    print(f"\n{'run':<20}{'stage':<15}{'median ms':>12}{'p95 ms':>12}")
+    for run, summary in results.items():
+        for stage, stats in summary.items():
+            print(f"{run:<20}{stage:<15}{stats['median_ms']:>12.2f}{stats['p95_ms']:>12.2f}")
+
+
+# stages slower than the baseline by more than threshold (and min_ms)
+def compare(results, baseline, threshold, min_ms):
+    regressions = []
+    for run, summary in results.items():
+        for stage, stats in summary.items():
+            old = baseline.get(run, {}).get(stage)
+            if not old:
+                continue
+            diff = stats["median_ms"] - old["median_ms"]
+            if diff > min_ms and stats["median_ms"] > old["median_ms"] * (1 + threshold):
+                regressions.append(f"{run} {stage}: {old['median_ms']:.2f} -> {stats['median_ms']:.2f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of both pipelines on synthetic invoices with a fake Gemini client.")
+    parser.add_argument("--docs", type=int, default=10, help="Number of synthetic invoices per variant.")
+    parser.add_argument("--min-pages", type=int, default=1)
+    parser.add_argument("--max-pages", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.0, help="Fake model latency in seconds.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--pages", default="all", help="Page selection spec passed to PageSelect (auto, all, N).")
+    parser.add_argument("--extractor", default="fitz", help="Text extraction backend for the BaseGemini path.")
+    parser.add_argument("--output", help="Write the report as JSON to this file.")
+    parser.add_argument("--compare", help="Baseline JSON report to check for regressions.")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed relative slowdown per stage.")
+    parser.add_argument("--min-ms", type=float, default=1.0, help="Ignore slowdowns smaller than this.")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    client = FakeClient(latency=args.latency)
+    profile = RenderProfile()
+    samples = {}
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        # untimed run so lazy imports and the template load don't count as a stage
+        warmup_file = os.path.join(work_dir, "warmup.pdf")
+        make_invoice(warmup_file, 1, False, random.Random(0))
+        run_base(warmup_file, client, work_dir, args.extractor, args.pages)
+        run_thinking(warmup_file, client, work_dir, profile, args.pages)
+
+        for variant in ("text", "scanned"):
+            for i in range(args.docs):
+                pdf_file = os.path.join(work_dir, f"{variant}_{i}.pdf")
+                make_invoice(pdf_file, rng.randint(args.min_pages, args.max_pages), variant == "scanned", rng)
+
+                runs = [("base/" + variant, run_base, args.extractor), ("thinking/" + variant, run_thinking, profile)]
+                for run, func, option in runs:
+                    times = func(pdf_file, client, work_dir, option, args.pages)
+                    times["total"] = sum(times.values())
+                    samples.setdefault(run, []).append(times)
+            print(f"Benchmarked {args.docs} {variant} invoices")
+
+    results = {run: summarize(run_samples) for run, run_samples in samples.items()}
+    print_report(results)
+
+    if args.output:
+        report = {"meta": {"docs": args.docs, "pages": [args.min_pages, args.max_pages], "page_selection": args.pages,
+                           "latency": args.latency,
+                           "seed": args.seed, "python": sys.version.split()[0]},
+                  "results": results}
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nReport written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold, args.min_ms)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+        print("\nNo regressions against the baseline.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import csv
+import json
+import os
+import threading
+import time
+
+from InvoiceRegister import AMOUNT_KEYS, to_number
+
+# flat columns for analytics: one row per invoice, one row per service line;
+# (column, key of extract_data_from_analysis)
+INVOICE_FIELDS = [
+    ("source", "source"),
+    ("document_name", "document_name"),
+    ("document_date", "document_date"),
+    ("document_number", "document_number"),
+    ("contract_info", "contract_info"),
+    ("executor_company", "Исполнитель_Компания"),
+    ("executor_address", "Исполнитель_Адрес"),
+    ("executor_unp", "Исполнитель_УНП"),
+    ("executor_bank_account", "Исполнитель_Расчетный_счет"),
+    ("executor_bank", "Исполнитель_Банк"),
+    ("client_company", "Заказчик_Компания"),
+    ("client_address", "Заказчик_Адрес"),
+    ("client_unp", "Заказчик_УНП"),
+    ("service_period", "За период"),
+    ("total_amount_words", "Общая стоимость услуг"),
+    ("vat_status", "НДС_Статус"),
+    ("director_position", "Директор_Должность"),
+    ("director_name", "Директор_ФИО"),
+]
+INVOICE_COLUMNS = ([column for column, _ in INVOICE_FIELDS]
+                   + ["document_day", "services", "amount_without_vat", "vat_amount", "amount_with_vat", "exported_at"])
+SERVICE_COLUMNS = ["source", "document_number", "document_day", "executor_unp", "line", "service_name",
+                   "amount_without_vat", "vat_rate", "vat_amount", "amount_with_vat"]
+FLOAT_COLUMNS = set(AMOUNT_KEYS)
+INT_COLUMNS = {"services", "line"}
+
+FORMATS = ("jsonl", "csv", "parquet")
+
+
+# "31.12.2024" -> "2024-12-31", so the files sort and filter by date as text
+def iso_date(value):
+    parts = str(value).strip().split(".")
+    if len(parts) == 3 and all(part.isdigit() for part in parts):
+        return f"{parts[2]}-{parts[1]}-{parts[0]}"
+    return ""
+
+
+def amount(value):
+    number = to_number(value)
+    return number if isinstance(number, float) else None
+
+
+# invoices.* and services.* in export_dir: JSONL and CSV are appended to, Parquet
+# (pyarrow, optional) gets a part file per flush in invoices/ and services/;
+# rows are buffered and written batch_size invoices at a time, or flush_seconds
+# after the oldest of them came in; on_flush gets the sources of every batch
+# written, so a journal can tell which documents still lack their rows
+class BulkExport:
+    def __init__(self, export_dir, formats=("jsonl", "csv"), batch_size=200, flush_seconds=60, on_flush=None):
+        self.export_dir = export_dir
+        self.formats = list(formats)
+        self.batch_size = max(1, batch_size)
+        self.flush_seconds = flush_seconds
+        self.on_flush = on_flush
+        if "parquet" in self.formats:
+            try:
+                import pyarrow  # type: ignore
+            except ImportError:
+                print("pyarrow не установлен, Parquet не пишется.")
+                self.formats.remove("parquet")
+        os.makedirs(export_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._invoices = []
+        self._services = []
+        self._oldest = None
+        self._parts = 0
+        self._sources = []
+        self.rows = 0
+        self._stop = threading.Event()
+        self._thread = None
+        if flush_seconds:
+            # a quiet service may not add another invoice for hours
+            self._thread = threading.Thread(target=self._timer, name="export-flush", daemon=True)
+            self._thread.start()
+
+    def _timer(self):
+        while not self._stop.wait(min(self.flush_seconds, 5)):
+            with self._lock:
+                if self._oldest is not None and time.monotonic() - self._oldest >= self.flush_seconds:
+                    try:
+                        self._flush()
+                    except OSError as e:
+                        print(f"Warning: export flush failed: {e}")
+
+    def add(self, source, data):
+        if not data:
+            return
+        day = iso_date(data.get("document_date", ""))
+        services = data.get("services", [])
+        invoice = {column: source if key == "source" else str(data.get(key, "") or "") for column, key in INVOICE_FIELDS}
+        invoice["document_day"] = day
+        invoice["services"] = len(services)
+        for key in AMOUNT_KEYS:
+            amounts = [amount(service.get(key, "")) for service in services]
+            invoice[key] = round(sum(a for a in amounts if a is not None), 2)
+        invoice["exported_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        lines = []
+        for n, service in enumerate(services, 1):
+            line = {"source": source, "document_number": invoice["document_number"], "document_day": day,
+                    "executor_unp": invoice["executor_unp"], "line": n}
+            for key in ("service_name", "amount_without_vat", "vat_rate", "vat_amount", "amount_with_vat"):
+                line[key] = amount(service.get(key, "")) if key in FLOAT_COLUMNS else str(service.get(key, "") or "")
+            lines.append(line)
+
+        with self._lock:
+            self._invoices.append(invoice)
+            self._services.extend(lines)
+            self._sources.append(source)
+            self.rows += 1
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            if len(self._invoices) >= self.batch_size or \
+                    (self.flush_seconds and time.monotonic() - self._oldest >= self.flush_seconds):
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._invoices:
+            return
+        self._parts += 1
+        for name, rows, columns in (("invoices", self._invoices, INVOICE_COLUMNS),
+                                    ("services", self._services, SERVICE_COLUMNS)):
+            if not rows:
+                continue
+            if "jsonl" in self.formats:
+                with open(os.path.join(self.export_dir, name + ".jsonl"), "a", encoding="utf-8") as f:
+                    f.write("".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows))
+            if "csv" in self.formats:
+                path = os.path.join(self.export_dir, name + ".csv")
+                new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+                with open(path, "a", encoding="utf-8", newline="") as f:
+                    writer = csv.DictWriter(f, fieldnames=columns)
+                    if new_file:
+                        writer.writeheader()
+                    writer.writerows(rows)
+            if "parquet" in self.formats:
+                self._write_parquet(name, rows, columns)
+        sources = self._sources
+        self._invoices = []
+        self._services = []
+        self._sources = []
+        self._oldest = None
+        if self.on_flush:
+            self.on_flush(sources)
+
+    def _write_parquet(self, name, rows, columns):
+        import pyarrow as pa  # type: ignore
+        import pyarrow.parquet as pq  # type: ignore
+
+        def column_type(column):
+            if column in FLOAT_COLUMNS:
+                return pa.float64()
+            return pa.int32() if column in INT_COLUMNS else pa.string()
+
+        schema = pa.schema([(column, column_type(column)) for column in columns])
+        part_dir = os.path.join(self.export_dir, name)
+        os.makedirs(part_dir, exist_ok=True)
+        # part files of several runs or processes never collide
+        part = f"part-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{self._parts:05d}.parquet"
+        pq.write_table(pa.Table.from_pylist(rows, schema=schema), os.path.join(part_dir, part))
+
+    def close(self):
+        self._stop.set()
+        self.flush()
+        print(f"Export of {self.rows} invoices written to {self.export_dir} ({', '.join(self.formats)})")
+
+
+def formats_option(value):
+    formats = [name.strip().lower() for name in value.split(",") if name.strip()]
+    unknown = [name for name in formats if name not in FORMATS]
+    if unknown or not formats:
+        import argparse
+        raise argparse.ArgumentTypeError(f"expected a comma-separated list of {', '.join(FORMATS)}")
+    return formats
@@ -0,0 +1,79 @@
+import threading
+import time
+
+from ApiRetry import error_code
+
+# the static instruction block is cached on the Gemini side once per run;
+# requests then reference it and carry only the document
+DEFAULT_TTL = 3600
+# refresh when less than this share of the TTL is left
+REFRESH_SHARE = 0.1
+
+
+class ContextCache:
+    def __init__(self, client, model, prefix, ttl=DEFAULT_TTL):
+        self.client = client
+        self.model = model
+        self.prefix = prefix
+        self.ttl = ttl
+        self.cache_name = None
+        self.disabled = False
+        self._expires = 0.0
+        self._lock = threading.Lock()
+
+    # the cache to reference, or None to send the full prompt
+    def name(self):
+        with self._lock:
+            if self.disabled:
+                return None
+            remaining = self._expires - time.monotonic()
+            if self.cache_name and remaining > self.ttl * REFRESH_SHARE:
+                return self.cache_name
+            try:
+                if self.cache_name and remaining > 0:
+                    self._refresh()
+                else:
+                    self._create()
+            except Exception as e:
+                # unsupported model, prompt below the minimum size, no quota: fall back for the whole run
+                print(f"Context caching unavailable for {self.model}, sending the full prompt: {e}")
+                self.disabled = True
+                self.cache_name = None
+            return self.cache_name
+
+    def _create(self):
+        from google.genai import types
+        cached = self.client.caches.create(model=self.model, config=types.CreateCachedContentConfig(
+            contents=[self.prefix], ttl=f"{self.ttl}s", display_name="invoice-prompt"))
+        self.cache_name = cached.name
+        self._expires = time.monotonic() + self.ttl
+
+    def _refresh(self):
+        from google.genai import types
+        try:
+            self.client.caches.update(name=self.cache_name, config=types.UpdateCachedContentConfig(ttl=f"{self.ttl}s"))
+            self._expires = time.monotonic() + self.ttl
+        except Exception as e:
+            if error_code(e) not in (403, 404):
+                raise
+            self._create()
+
+    # a request found the cache gone (expired or deleted on the server)
+    def invalidate(self, cache_name):
+        with self._lock:
+            if self.cache_name == cache_name:
+                self.cache_name = None
+                self._expires = 0.0
+
+    def close(self):
+        with self._lock:
+            if self.cache_name:
+                try:
+                    self.client.caches.delete(name=self.cache_name)
+                except Exception:
+                    pass  # it expires by itself
+            self.cache_name = None
+
+
+def is_missing_cache(error):
+    return error_code(error) in (400, 403, 404) and "cache" in str(error).lower()
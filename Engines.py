@@ -0,0 +1,215 @@
+import os
+
+import BaseGemini
+import LocalExtract
+import ThinkingGemini
+from ContextCache import ContextCache
+from InvoiceSchema import Invoice, check_invoice, check_totals, validate
+from LayoutTemplates import LayoutTemplates
+from Metrics import DocumentMetrics, timed
+from PageRender import RenderProfile, release_pages, render_pages, report_skipped
+from PageSelect import MIN_TEXT_CHARS, select_pages
+from TextExtract import extract_text
+
+
+# both engines take the options of the CLI that built them; options a CLI
+# doesn't have fall back to the defaults below
+def option(args, name, default=None):
+    return getattr(args, name, default)
+
+
+# learned vendor layouts: no model call at all, but only for vendors seen before
+class LayoutEngine:
+    name = "layout"
+
+    def __init__(self, client, limiter, cache, args, render_pool=None):
+        self.templates = LayoutTemplates(option(args, "templates_dir", ".layout_templates"))
+
+    def analyze(self, pdf_file, metrics=None, pages=None):
+        with timed(metrics, "layout"):
+            try:
+                analysis_result = self.templates.extract(pdf_file)
+            except Exception as e:
+                analysis_result = f"Error: {e}"
+        if metrics and not isinstance(analysis_result, str):
+            metrics.parse_path = "layout"
+        return analysis_result
+
+    # called by the cascade with the answer of a later engine that passed validation
+    def learn(self, pdf_file, analysis_result):
+        try:
+            reason = self.templates.learn(pdf_file, analysis_result)
+        except Exception as e:
+            reason = str(e)
+        if not reason:
+            print(f"{os.path.basename(pdf_file)}: макет исполнителя сохранен, "
+                  f"следующие его счета читаются без запроса к модели.")
+
+    def close(self):
+        pass
+
+
+# text layer -> gemini-2.0-flash: cheap, but blind to scans and unusual layouts
+class TextEngine:
+    name = "text"
+
+    def __init__(self, client, limiter, cache, args, render_pool=None):
+        self.client = client
+        self.limiter = limiter
+        self.cache = cache
+        self.pages = option(args, "pages", "auto")
+        self.extractor = option(args, "extractor", "fitz")
+        self.prefill = not option(args, "no_prefill", False)
+        self.context = None
+        if not option(args, "no_context_cache", False):
+            self.context = ContextCache(client, BaseGemini.model, BaseGemini.PROMPT_PREFIX,
+                                        option(args, "context_ttl", 3600))
+
+    # the text of the selected pages, or None when there is no usable text layer
+    def read(self, pdf_file, metrics=None, pages=None):
+        import fitz
+        with timed(metrics, "open"):
+            doc = fitz.open(pdf_file)
+        try:
+            with timed(metrics, "select"):
+                page_numbers = select_pages(doc, pages or self.pages)
+            with timed(metrics, "extract_text"):
+                invoice_text = extract_text(doc, page_numbers, self.extractor)
+        finally:
+            doc.close()
+        if metrics:
+            metrics.pages = len(page_numbers)
+        return invoice_text if len(invoice_text.strip()) >= MIN_TEXT_CHARS else None
+
+    def analyze(self, pdf_file, metrics=None, pages=None):
+        invoice_text = self.read(pdf_file, metrics, pages)
+        if invoice_text is None:
+            return "Error: no usable text layer"
+        analysis_result = BaseGemini.analyze_invoice(invoice_text, self.client, self.cache, metrics, self.limiter,
+                                                     self.prefill, self.context)
+        # a cached answer skipped the checks against the text, they are repeated here
+        if metrics and metrics.parse_path == "cache" and not isinstance(analysis_result, str) and \
+                check_invoice(Invoice.from_dict(analysis_result), LocalExtract.scan(invoice_text)):
+            metrics.parse_path = "invalid"
+        return analysis_result
+
+    def close(self):
+        if self.context:
+            self.context.close()
+
+
+# page images -> the thinking model: reads anything, costs several times more
+class VisionEngine:
+    name = "vision"
+
+    def __init__(self, client, limiter, cache, args, render_pool=None):
+        self.client = client
+        self.limiter = limiter
+        self.cache = cache
+        self.render_pool = render_pool
+        self.pages = option(args, "pages", "auto")
+        self.profile = RenderProfile(dpi=option(args, "dpi", 72), color=option(args, "color", "rgb"),
+                                     image_format=option(args, "format", "png"), quality=option(args, "quality", 85),
+                                     max_dim=option(args, "max_dim", 0))
+        self.memory_cap = option(args, "memory_cap", 0) * 1024 * 1024
+        self.spool_dir = option(args, "spool_dir")
+        self.upload_pages = option(args, "upload_pages", False)
+        self.skip_pages = not option(args, "keep_all_pages", False)
+        self.context = None
+        if not option(args, "no_context_cache", False):
+            self.context = ContextCache(client, ThinkingGemini.model, ThinkingGemini.PROMPT_PREFIX,
+                                        option(args, "context_ttl", 3600))
+
+    def analyze(self, pdf_file, metrics=None, pages=None):
+        render_args = (pdf_file, pages or self.pages, self.profile, False, self.memory_cap, self.spool_dir,
+                       self.skip_pages)
+        with timed(metrics, "render"):
+            if self.render_pool:
+                image_data, _, skipped = self.render_pool.submit(render_pages, *render_args).result()
+            else:
+                image_data, _, skipped = render_pages(*render_args)
+        report_skipped(pdf_file, image_data, skipped, metrics)
+        if metrics:
+            metrics.pages = len(image_data)
+            metrics.payload_bytes = sum(len(data) for data, _ in image_data)
+        try:
+            return ThinkingGemini.analyze_invoice(image_data, self.client, self.limiter, self.cache, metrics,
+                                                  self.context, self.memory_cap, self.upload_pages)
+        finally:
+            release_pages(image_data)
+
+    def close(self):
+        if self.context:
+            self.context.close()
+
+
+# cheapest first: the cascade tries them in this order
+ENGINES = {"layout": LayoutEngine, "text": TextEngine, "vision": VisionEngine}
+
+
+# why an answer is not good enough to stop at, or None; parse_path "invalid"
+# is the engine's own verdict (e.g. a BIC that is not in the text)
+def escalation_reason(analysis_result, parse_path=""):
+    if isinstance(analysis_result, str):
+        return analysis_result.removeprefix("Error: ")
+    if parse_path == "invalid":
+        return "invalid: failed the engine's checks against the document"
+    invoice = Invoice.from_dict(analysis_result)
+    errors = validate(invoice)
+    if errors:
+        return "invalid: " + ", ".join(errors)
+    errors = check_totals(invoice)
+    if errors:
+        return "totals: " + ", ".join(errors)
+    return None
+
+
+# every document starts on the cheapest engine and moves to the next one only
+# when the answer fails validation; the route taken goes into the metrics
+class Cascade:
+    name = "cascade"
+
+    def __init__(self, engines):
+        self.engines = engines
+
+    def analyze(self, pdf_file, metrics=None, pages=None):
+        # the engines report their own verdict through the metrics, so there always are some
+        metrics = metrics or DocumentMetrics(pdf_file)
+        route = []
+        reasons = []
+        for engine in self.engines:
+            route.append(engine.name)
+            metrics.parse_path = ""
+            analysis_result = engine.analyze(pdf_file, metrics, pages)
+            reason = escalation_reason(analysis_result, metrics.parse_path)
+            if reason is None:
+                # the engines that failed before may learn from the answer that passed
+                for failed in self.engines[:len(route) - 1]:
+                    if hasattr(failed, "learn"):
+                        failed.learn(pdf_file, analysis_result)
+                break
+            if engine is self.engines[-1]:
+                # the last engine's answer is kept even when it doesn't validate either
+                break
+            reasons.append(f"{engine.name}: {reason}")
+            # the failed attempt stays in the token and time totals, not in the outcome
+            metrics.error = ""
+        if reasons:
+            print(f"{os.path.basename(pdf_file)}: {' -> '.join(route)} ({'; '.join(reasons)})")
+        metrics.route = ">".join(route)
+        metrics.escalation = "; ".join(reasons)
+        return analysis_result
+
+    def close(self):
+        for engine in self.engines:
+            engine.close()
+
+
+def build_engine(name, client, limiter, cache, args, render_pool=None):
+    if name == Cascade.name:
+        return Cascade([engine(client, limiter, cache, args, render_pool) for engine_name, engine in ENGINES.items()
+                        if not (engine_name == "layout" and option(args, "no_templates", False))])
+    return ENGINES[name](client, limiter, cache, args, render_pool)
+
+
+ENGINE_NAMES = list(ENGINES) + [Cascade.name]
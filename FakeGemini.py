@@ -0,0 +1,206 @@
+import json
+import random
+import threading
+import time
+
+# local stand-in for genai.Client: returns canned JSON after a configurable
+# latency and records every call, so pipelines can be run and timed offline
+
+CANNED_ANALYSIS = {
+    "document_info": {
+        "document_name": "Бухгалтерская справка № Б.Н.",
+        "document_date": "31.12.2024",
+        "document_number": "счет № 284",
+        "contract_info": "по договору № ПО-103 от 01.09.2019"
+    },
+    "executor": {
+        "company_name": "ООО 'СофтСервис'",
+        "address": "г. Гродно, ул. Ленина, 5/2",
+        "unp": "500484719",
+        "bank_account": "BY22 BELB 3012 1401 7701 1022 6000",
+        "bank_name": "ОАО 'БАНК БЕЛВЭБ' BELBBY2X"
+    },
+    "client": {
+        "company_name": "ООО 'ДЕВКРАФТ'",
+        "address": "г. Гродно, ул Мостовая, 31",
+        "unp": "591007097"
+    },
+    "service_period": "с 01.12.2024 по 31.12.2024",
+    "service_details": [
+        {
+            "service_name": "Сопровождение программного обеспечения",
+            "amount_without_vat": "290,00",
+            "vat_rate": "Без НДС",
+            "vat_amount": "-",
+            "amount_with_vat": "290,00"
+        }
+    ],
+    "total_amount_words": "Двести девяносто белорусских рублей 00 копеек",
+    "vat_status": "Без НДС",
+    "director": {
+        "company_name": "ООО 'ДЕВКРАФТ'",
+        "position": "Директор",
+        "full_name": "А.В.Яговдик"
+    }
+}
+
+# same rough estimate the rate limiter uses
+IMAGE_TOKENS = 258
+
+
+class FakeUsage:
+    def __init__(self, prompt_token_count, candidates_token_count, cached_content_token_count=0):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.cached_content_token_count = cached_content_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+
+class FakeResponse:
+    def __init__(self, text, usage_metadata):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+
+# looks like google.genai.errors.APIError to the retry layer
+class FakeApiError(Exception):
+    STATUS = {400: "INVALID_ARGUMENT", 404: "NOT_FOUND", 429: "RESOURCE_EXHAUSTED"}
+
+    def __init__(self, code, retry_delay=None, message=""):
+        self.code = code
+        self.details = {"error": {"code": code, "status": self.STATUS.get(code, "UNAVAILABLE"), "message": message,
+                                  "details": [{"retryDelay": f"{retry_delay}s"}] if retry_delay is not None else []}}
+        super().__init__(f"{code} {self.details['error']['status']}. {message}".strip(". "))
+
+
+class FakeCachedContent:
+    def __init__(self, name, model, tokens, expires):
+        self.name = name
+        self.model = model
+        self.tokens = tokens
+        self.expires = expires
+
+
+# stand-in for client.caches: names, TTLs and expiry, but no server
+class FakeCaches:
+    def __init__(self, client):
+        self._client = client
+        self._entries = {}
+
+    def _ttl(self, config):
+        return float(str(getattr(config, "ttl", None) or "3600s").rstrip("s"))
+
+    def create(self, model, config=None):
+        client = self._client
+        if not client.supports_caching:
+            raise FakeApiError(400, message=f"Model {model} does not support context caching")
+        with client._lock:
+            name = f"cachedContents/fake-{client.cache_creates + 1}"
+            self._entries[name] = FakeCachedContent(name, model, count_tokens(getattr(config, "contents", None) or []),
+                                                    time.monotonic() + self._ttl(config))
+            client.cache_creates += 1
+            return self._entries[name]
+
+    def get(self, name):
+        entry = self._entries.get(name)
+        if not entry or entry.expires < time.monotonic():
+            raise FakeApiError(404, message=f"CachedContent not found: {name}")
+        return entry
+
+    def update(self, name, config=None):
+        entry = self.get(name)
+        entry.expires = time.monotonic() + self._ttl(config)
+        return entry
+
+    def delete(self, name):
+        self._entries.pop(name, None)
+
+
+def count_tokens(contents):
+    tokens = 0
+    for part in contents:
+        tokens += len(part) // 4 if isinstance(part, str) else IMAGE_TOKENS
+    return tokens
+
+
+class FakeFile:
+    def __init__(self, name, mime_type):
+        self.name = name
+        self.uri = "https://fake.invalid/v1beta/" + name
+        self.mime_type = mime_type
+
+
+# stand-in for client.files: keeps track of what is uploaded and not deleted yet
+class FakeFiles:
+    def __init__(self, client):
+        self._client = client
+        self.uploaded = {}
+
+    def upload(self, file, config=None):
+        with self._client._lock:
+            name = f"files/fake-{self._client.uploads + 1}"
+            self._client.uploads += 1
+            self.uploaded[name] = FakeFile(name, getattr(config, "mime_type", None))
+            return self.uploaded[name]
+
+    def delete(self, name):
+        self.uploaded.pop(name, None)
+
+
+class FakeModels:
+    def __init__(self, client):
+        self._client = client
+
+    def generate_content(self, model, contents, config=None):
+        client = self._client
+        start = time.monotonic()
+        cached = client.caches.get(config.cached_content) if getattr(config, "cached_content", None) else None
+        with client._lock:
+            client.active += 1
+            # a quota on concurrent requests, or random throttling
+            throttled = (client.max_concurrent and client.active > client.max_concurrent) or \
+                client._rng.random() < client.throttle_rate
+            if throttled:
+                client.active -= 1
+                client.throttled += 1
+        if throttled:
+            raise FakeApiError(429, client.retry_delay)
+        try:
+            time.sleep(client.latency)
+        finally:
+            with client._lock:
+                client.active -= 1
+        response = client.response
+        if callable(response):
+            response = response(model, contents, config)
+        text = response if isinstance(response, str) else json.dumps(response, ensure_ascii=False, indent=2)
+        if client.fenced:
+            text = "```json\n" + text + "\n```"
+        with client._lock:
+            client.calls.append({"model": model, "start": start, "end": time.monotonic(), "config": config})
+        cached_tokens = cached.tokens if cached else 0
+        return FakeResponse(text, FakeUsage(count_tokens(contents) + cached_tokens, len(text) // 4, cached_tokens))
+
+
+class FakeClient:
+    def __init__(self, api_key=None, latency=0.0, response=None, fenced=True,
+                 throttle_rate=0.0, max_concurrent=0, retry_delay=None, seed=0, supports_caching=True):
+        self.latency = latency
+        # a dict/str, or a callable(model, contents, config) returning one
+        self.response = CANNED_ANALYSIS if response is None else response
+        self.fenced = fenced
+        # 429 injection: probability per call and/or a concurrency quota
+        self.throttle_rate = throttle_rate
+        self.max_concurrent = max_concurrent
+        self.retry_delay = retry_delay
+        self.active = 0
+        self.throttled = 0
+        self._rng = random.Random(seed)
+        self.supports_caching = supports_caching
+        self.cache_creates = 0
+        self.uploads = 0
+        self.calls = []
+        self._lock = threading.Lock()
+        self.models = FakeModels(self)
+        self.caches = FakeCaches(self)
+        self.files = FakeFiles(self)
@@ -0,0 +1,67 @@
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+MODULES = ["BaseGemini", "ThinkingGemini"]
+
+# must only be imported on the code path that uses them
+HEAVY_MODULES = ["google.genai", "fitz", "pymupdf", "openpyxl", "PIL", "markitdown"]
+
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+# imports `module` in a fresh interpreter with -X importtime and returns
+# its cumulative import time in ms plus the names of all imported modules
+def measure(module):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+    cumulative_us = 0
+    imported = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        imported.append(match.group(4))
+        if match.group(4) == module:
+            cumulative_us = int(match.group(2))
+    return cumulative_us / 1000, imported
+
+
+def check(budget_ms, repeat=3):
+    failures = []
+    for module in MODULES:
+        # best of several runs, the first one also pays for cold disk caches
+        runs = [measure(module) for _ in range(repeat)]
+        import_ms = min(ms for ms, _ in runs)
+        imported = runs[0][1]
+        heavy = sorted({name for name in imported for heavy in HEAVY_MODULES
+                        if name == heavy or name.startswith(heavy + ".")})
+
+        print(f"{module}: {import_ms:.1f} ms (budget {budget_ms} ms)")
+        if import_ms > budget_ms:
+            failures.append(f"{module} import takes {import_ms:.1f} ms, budget is {budget_ms} ms")
+        if heavy:
+            failures.append(f"{module} imports {', '.join(heavy)} at import time")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that the CLI modules import within the startup time budget.")
+    parser.add_argument("--budget-ms", type=float, default=100, help="Max cumulative import time of each module.")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of measurements per module, the best one counts.")
+    args = parser.parse_args()
+
+    failures = check(args.budget_ms, args.repeat)
+    for failure in failures:
+        print(f"Error: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import os
+import socket
+import threading
+import time
+
+# a worker that hasn't touched its heartbeat for this long is considered dead
+LEASE_SECONDS = 120
+HEARTBEAT = ".alive"
+
+
+# claims of inbox files: a file is claimed by renaming it into the worker's
+# .work/ directory, and of several processes or hosts renaming the same file
+# only one succeeds. Shared inboxes give every worker its own .work/<worker>/
+# and a heartbeat file; files of a worker whose heartbeat went stale are
+# renamed back into the inbox, so a crashed host doesn't lose them
+class InboxClaims:
+    def __init__(self, inbox, shared=False, worker_id=None, lease=LEASE_SECONDS):
+        self.inbox = inbox
+        self.shared = shared
+        self.lease = lease
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.work_root = os.path.join(inbox, ".work")
+        self.work_dir = os.path.join(self.work_root, self.worker_id) if shared else self.work_root
+        for path in (self.work_dir, os.path.join(inbox, "processed"), os.path.join(inbox, "failed")):
+            os.makedirs(path, exist_ok=True)
+        self._stop = threading.Event()
+        self._thread = None
+        if shared:
+            self.heartbeat()
+            self._thread = threading.Thread(target=self._beat, name="heartbeat", daemon=True)
+            self._thread.start()
+
+    def heartbeat(self):
+        with open(os.path.join(self.work_dir, HEARTBEAT), "w") as f:
+            f.write(f"{time.time():.0f}\n")
+
+    def _beat(self):
+        while not self._stop.wait(self.lease / 4):
+            try:
+                self.heartbeat()
+            except OSError as e:
+                print(f"Warning: heartbeat of '{self.worker_id}' failed: {e}")
+
+    # the claimed path, or None when another worker was faster
+    def claim(self, path):
+        claimed = os.path.join(self.work_dir, os.path.basename(path))
+        try:
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            return None
+        return claimed
+
+    # moves a claimed file to processed/ or failed/; False when it is no longer
+    # ours (the heartbeat stalled long enough for another worker to take it back)
+    def finish(self, claimed, target):
+        try:
+            os.replace(claimed, os.path.join(self.inbox, target, os.path.basename(claimed)))
+        except FileNotFoundError:
+            print(f"Warning: '{os.path.basename(claimed)}' was taken back from this worker, "
+                  f"another one may have processed it too.")
+            return False
+        return True
+
+    # files this worker claimed before a restart under the same id
+    def leftovers(self):
+        return [entry.path for entry in os.scandir(self.work_dir)
+                if entry.is_file() and entry.name.lower().endswith(".pdf")]
+
+    # puts the files of dead workers back into the inbox; returns how many
+    def recover(self):
+        if not self.shared:
+            return 0
+        returned = 0
+        now = time.time()
+        for entry in os.scandir(self.work_root):
+            if entry.is_file() and entry.name.lower().endswith(".pdf"):
+                # left in .work/ by a run without --shared
+                returned += self._return(entry.path)
+                continue
+            if not entry.is_dir() or entry.path == self.work_dir:
+                continue
+            try:
+                beat = os.stat(os.path.join(entry.path, HEARTBEAT)).st_mtime
+            except FileNotFoundError:
+                beat = entry.stat().st_mtime
+            if now - beat < self.lease:
+                continue
+            for claimed in os.scandir(entry.path):
+                if claimed.is_file() and claimed.name.lower().endswith(".pdf"):
+                    returned += self._return(claimed.path)
+            try:
+                os.remove(os.path.join(entry.path, HEARTBEAT))
+                os.rmdir(entry.path)
+            except OSError:
+                pass  # the worker came back or another one is cleaning up
+        return returned
+
+    def _return(self, path):
+        target = os.path.join(self.inbox, os.path.basename(path))
+        if os.path.exists(target):
+            # a new file of the same name was dropped meanwhile, rename() would overwrite it
+            stem, ext = os.path.splitext(target)
+            target = f"{stem}.{int(time.time())}{ext}"
+        try:
+            os.rename(path, target)
+        except FileNotFoundError:
+            return 0  # another worker returned it first
+        print(f"'{os.path.basename(path)}' возвращен в очередь после остановленного обработчика.")
+        return 1
+
+    def close(self):
+        self._stop.set()
+        # with files still claimed the heartbeat is left to go stale, so they are recovered after the lease
+        if self.shared and not self.leftovers():
+            try:
+                os.remove(os.path.join(self.work_dir, HEARTBEAT))
+                os.rmdir(self.work_dir)
+            except OSError:
+                pass
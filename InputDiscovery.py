@@ -0,0 +1,60 @@
+import fnmatch
+import os
+import time
+
+
+def matches(rel_path, name, patterns):
+    # a pattern without "/" is matched against the file name, otherwise against the relative path
+    for pattern in patterns:
+        target = rel_path if "/" in pattern else name
+        if fnmatch.fnmatchcase(target.lower(), pattern.lower()):
+            return True
+    return False
+
+
+# lazily walks the tree with os.scandir, so the first file is handed out
+# before the rest of the archive has been listed; excluded directories are
+# not descended into, symlinked directories are not followed
+def find_pdfs(root, include=("*.pdf",), exclude=(), recursive=True,
+              min_size=0, max_size=0, modified_after=None, modified_before=None):
+    stack = [""]
+    while stack:
+        rel_dir = stack.pop()
+        try:
+            entries = os.scandir(os.path.join(root, rel_dir) if rel_dir else root)
+        except OSError as e:
+            print(f"Error: Cannot read directory '{os.path.join(root, rel_dir)}': {e}")
+            continue
+        subdirs = []
+        with entries:
+            for entry in entries:
+                rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                if matches(rel_path, entry.name, exclude):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            subdirs.append(rel_path)
+                        continue
+                    if not entry.is_file() or not matches(rel_path, entry.name, include):
+                        continue
+                    if min_size or max_size or modified_after or modified_before:
+                        stat = entry.stat()
+                        if stat.st_size < min_size or (max_size and stat.st_size > max_size):
+                            continue
+                        if (modified_after and stat.st_mtime < modified_after) or \
+                                (modified_before and stat.st_mtime >= modified_before):
+                            continue
+                except OSError:
+                    continue
+                yield entry.path
+        # depth-first, in listing order
+        stack.extend(reversed(subdirs))
+
+
+def date_option(value):
+    try:
+        return time.mktime(time.strptime(value, "%Y-%m-%d"))
+    except ValueError:
+        import argparse
+        raise argparse.ArgumentTypeError("expected a date as YYYY-MM-DD")
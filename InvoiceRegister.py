@@ -0,0 +1,82 @@
+import os
+import threading
+
+INVOICE_COLUMNS = [
+    ("Файл", "source"),
+    ("Дата", "document_date"),
+    ("Номер счета", "document_number"),
+    ("Договор", "contract_info"),
+    ("Исполнитель", "Исполнитель_Компания"),
+    ("УНП исполнителя", "Исполнитель_УНП"),
+    ("Адрес исполнителя", "Исполнитель_Адрес"),
+    ("Расчетный счет", "Исполнитель_Расчетный_счет"),
+    ("Банк", "Исполнитель_Банк"),
+    ("Заказчик", "Заказчик_Компания"),
+    ("УНП заказчика", "Заказчик_УНП"),
+    ("За период", "За период"),
+    ("НДС", "НДС_Статус"),
+    ("Сумма прописью", "Общая стоимость услуг"),
+]
+
+SERVICE_COLUMNS = [
+    ("Наименование услуги", "service_name"),
+    ("Сумма без НДС, руб.", "amount_without_vat"),
+    ("Ставка НДС", "vat_rate"),
+    ("Сумма НДС, руб.", "vat_amount"),
+    ("Сумма с НДС, руб.", "amount_with_vat"),
+]
+
+AMOUNT_KEYS = ("amount_without_vat", "vat_amount", "amount_with_vat")
+
+
+def to_number(value):
+    try:
+        return float(str(value).replace(" ", "").replace(",", "."))
+    except ValueError:
+        return value
+
+
+# one workbook for the whole batch: an invoice per row on the first sheet,
+# service lines on the second; write-only mode streams rows to disk. With append
+# the rows go under those of an existing register (loaded whole, for runs that
+# add a file at a time)
+class InvoiceRegister:
+    def __init__(self, excel_file, append=False):
+        import openpyxl
+        self.excel_file = excel_file
+        self._lock = threading.Lock()
+        self.rows = 0
+        if append and os.path.exists(excel_file):
+            self._wb = openpyxl.load_workbook(excel_file)
+            self._invoices = self._wb["Счета"]
+            self._services = self._wb["Услуги"]
+            self.rows = self._invoices.max_row - 1
+            return
+        self._wb = openpyxl.Workbook(write_only=True)
+        self._invoices = self._wb.create_sheet("Счета")
+        self._services = self._wb.create_sheet("Услуги")
+        self._invoices.append([title for title, _ in INVOICE_COLUMNS] + ["Сумма без НДС, руб.", "Сумма НДС, руб.", "Сумма с НДС, руб."])
+        self._services.append(["Файл", "Номер счета"] + [title for title, _ in SERVICE_COLUMNS])
+
+    def add(self, source, data):
+        if not data:
+            return
+        services = data.get("services", [])
+        totals = []
+        for key in AMOUNT_KEYS:
+            amounts = [to_number(service.get(key, "")) for service in services]
+            totals.append(sum(a for a in amounts if isinstance(a, float)))
+
+        row = [source if key == "source" else data.get(key, "") for _, key in INVOICE_COLUMNS]
+        with self._lock:
+            self._invoices.append(row + totals)
+            for service in services:
+                self._services.append([source, data.get("document_number", "")] +
+                                      [to_number(service.get(key, "")) if key in AMOUNT_KEYS else service.get(key, "")
+                                       for _, key in SERVICE_COLUMNS])
+            self.rows += 1
+
+    def close(self):
+        with self._lock:
+            self._wb.save(self.excel_file)
+        print(f"Register with {self.rows} invoices written to {self.excel_file}")
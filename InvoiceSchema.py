@@ -0,0 +1,447 @@
+import json
+import re
+from dataclasses import dataclass, field, fields, asdict
+
+from Metrics import timed
+from ContextCache import is_missing_cache
+
+
+@dataclass
+class DocumentInfo:
+    document_name: str = ""
+    document_date: str = ""
+    document_number: str = ""
+    contract_info: str = ""
+
+
+@dataclass
+class Executor:
+    company_name: str = ""
+    address: str = ""
+    unp: str = ""
+    bank_account: str = ""
+    bank_name: str = ""
+
+
+@dataclass
+class Client:
+    company_name: str = ""
+    address: str = ""
+    unp: str = ""
+
+
+@dataclass
+class Service:
+    service_name: str = ""
+    amount_without_vat: str = ""
+    vat_rate: str = ""
+    vat_amount: str = ""
+    amount_with_vat: str = ""
+
+
+@dataclass
+class Director:
+    company_name: str = ""
+    position: str = ""
+    full_name: str = ""
+
+
+@dataclass
+class Invoice:
+    document_info: DocumentInfo = field(default_factory=DocumentInfo)
+    executor: Executor = field(default_factory=Executor)
+    client: Client = field(default_factory=Client)
+    service_period: str = ""
+    service_details: list = field(default_factory=list)
+    total_amount_words: str = ""
+    vat_status: str = ""
+    director: Director = field(default_factory=Director)
+
+    @classmethod
+    def from_dict(cls, data):
+        def build(record_cls, values):
+            values = values if isinstance(values, dict) else {}
+            return record_cls(**{f.name: text(values.get(f.name)) for f in fields(record_cls)})
+
+        services = data.get("service_details")
+        return cls(
+            document_info=build(DocumentInfo, data.get("document_info")),
+            executor=build(Executor, data.get("executor")),
+            client=build(Client, data.get("client")),
+            service_period=text(data.get("service_period")),
+            service_details=[build(Service, s) for s in services] if isinstance(services, list) else [],
+            total_amount_words=text(data.get("total_amount_words")),
+            vat_status=text(data.get("vat_status")),
+            director=build(Director, data.get("director")),
+        )
+
+    def to_dict(self):
+        return asdict(self)
+
+
+def text(value):
+    if value is None:
+        return ""
+    return value if isinstance(value, str) else str(value)
+
+
+def object_schema(record_cls, required=()):
+    return {"type": "OBJECT",
+            "properties": {f.name: {"type": "STRING"} for f in fields(record_cls)},
+            "required": list(required)}
+
+
+# response_schema for the SDK, mirrors the JSON example of the prompts
+RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "document_info": object_schema(DocumentInfo, ["document_date", "document_number"]),
+        "executor": object_schema(Executor, ["company_name", "unp"]),
+        "client": object_schema(Client, ["company_name"]),
+        "service_period": {"type": "STRING"},
+        "service_details": {"type": "ARRAY", "items": object_schema(Service, ["service_name", "amount_with_vat"])},
+        "total_amount_words": {"type": "STRING"},
+        "vat_status": {"type": "STRING"},
+        "director": object_schema(Director),
+    },
+    "required": ["document_info", "executor", "client", "service_details"],
+}
+
+PACK_SCHEMA = {
+    "type": "ARRAY",
+    "items": {**RESPONSE_SCHEMA,
+              "properties": {"document_id": {"type": "STRING"}, **RESPONSE_SCHEMA["properties"]},
+              "required": ["document_id"] + RESPONSE_SCHEMA["required"]},
+}
+
+
+# the schema without the fields that are already known, so the model doesn't spend output on them
+def residual_schema(known_paths, schema=RESPONSE_SCHEMA):
+    schema = json.loads(json.dumps(schema))
+    for path in known_paths:
+        group, _, name = path.rpartition(".")
+        target = schema["properties"][group] if group else schema
+        target["properties"].pop(name, None)
+        if name in target.get("required", []):
+            target["required"].remove(name)
+    for group in list(schema["properties"]):
+        nested = schema["properties"][group]
+        if nested.get("type") == "OBJECT" and not nested["properties"]:
+            del schema["properties"][group]
+    schema["required"] = [name for name in schema["required"] if name in schema["properties"]]
+    return schema
+
+
+# experimental thinking models reject response_schema, they get the same
+# validation but without constrained decoding
+def supports_schema(model):
+    return "thinking-exp" not in model
+
+
+def generation_config(model, schema=RESPONSE_SCHEMA, cached_content=None):
+    if not supports_schema(model) and not cached_content:
+        return None
+    from google.genai import types
+    if not supports_schema(model):
+        return types.GenerateContentConfig(cached_content=cached_content)
+    return types.GenerateContentConfig(response_mime_type="application/json", response_schema=schema,
+                                       cached_content=cached_content)
+
+
+REQUIRED_FIELDS = ["document_info.document_date", "document_info.document_number",
+                   "executor.company_name", "executor.unp", "client.company_name"]
+
+# every field the справка shows; an answer built without the model must have them all
+SPRAVKA_FIELDS = ["document_info.document_name", "document_info.document_date", "document_info.document_number",
+                  "document_info.contract_info", "executor.company_name", "executor.address", "executor.unp",
+                  "executor.bank_account", "executor.bank_name", "client.company_name", "client.address",
+                  "client.unp", "service_period", "total_amount_words", "vat_status", "director.position",
+                  "director.full_name"]
+
+DATE = re.compile(r"\d{2}\.\d{2}\.\d{4}")
+UNP = re.compile(r"\d{9}")
+IBAN = re.compile(r"BY\d{2}[A-Z0-9]{4}\d{20}")
+AMOUNT = re.compile(r"-|-?\d[\d ]*(,\d+)?")
+PERIOD = re.compile(r"с \d{2}\.\d{2}\.\d{4} по \d{2}\.\d{2}\.\d{4}")
+
+
+def get_field(invoice, path):
+    value = invoice
+    for name in path.split("."):
+        value = value[int(name)] if isinstance(value, list) else getattr(value, name)
+    return value
+
+
+# field paths that are missing or malformed
+def validate(invoice):
+    errors = [path for path in REQUIRED_FIELDS if not get_field(invoice, path).strip()]
+
+    def check(path, pattern, normalize=lambda v: v):
+        value = get_field(invoice, path).strip()
+        if value and not pattern.fullmatch(normalize(value)):
+            errors.append(path)
+
+    check("document_info.document_date", DATE)
+    check("executor.unp", UNP)
+    check("client.unp", UNP)
+    check("executor.bank_account", IBAN, lambda v: v.replace(" ", ""))
+    check("service_period", PERIOD)
+    if not invoice.service_details:
+        errors.append("service_details")
+    for i, service in enumerate(invoice.service_details):
+        if not service.amount_with_vat.strip():
+            errors.append(f"service_details.{i}.amount_with_vat")
+        for name in ("amount_without_vat", "vat_amount", "amount_with_vat"):
+            check(f"service_details.{i}.{name}", AMOUNT)
+    return list(dict.fromkeys(errors))
+
+
+# "1 234,56" -> 1234.56; None for "-", blanks and anything unreadable
+def amount_value(text):
+    text = text.strip().replace(" ", "").replace(",", ".")
+    try:
+        return float(text) if text and text != "-" else None
+    except ValueError:
+        return None
+
+
+HUNDREDS = ["", "сто", "двести", "триста", "четыреста", "пятьсот", "шестьсот", "семьсот", "восемьсот", "девятьсот"]
+TENS = ["", "", "двадцать", "тридцать", "сорок", "пятьдесят", "шестьдесят", "семьдесят", "восемьдесят", "девяносто"]
+TEENS = ["десять", "одиннадцать", "двенадцать", "тринадцать", "четырнадцать", "пятнадцать", "шестнадцать",
+         "семнадцать", "восемнадцать", "девятнадцать"]
+UNITS = ["", "один", "два", "три", "четыре", "пять", "шесть", "семь", "восемь", "девять"]
+# (forms for 1, 2-4, 5+; feminine)
+SCALES = [(("", "", ""), False), (("тысяча", "тысячи", "тысяч"), True), (("миллион", "миллиона", "миллионов"), False)]
+
+
+def plural(n, forms):
+    if 11 <= n % 100 <= 14:
+        return forms[2]
+    return forms[0] if n % 10 == 1 else forms[1] if 2 <= n % 10 <= 4 else forms[2]
+
+
+def number_words(n):
+    if n == 0:
+        return "ноль"
+    words = []
+    for scale, (forms, feminine) in enumerate(SCALES):
+        group = n // 1000 ** scale % 1000
+        if not group:
+            continue
+        part = [HUNDREDS[group // 100]]
+        if 10 <= group % 100 < 20:
+            part.append(TEENS[group % 10])
+        else:
+            unit = UNITS[group % 10]
+            if feminine and group % 10 in (1, 2):
+                unit = "одна" if group % 10 == 1 else "две"
+            part += [TENS[group // 10 % 10], unit]
+        part.append(plural(group, forms))
+        words = [w for w in part if w] + words
+    return " ".join(words)
+
+
+# 113.13 -> "Сто тринадцать белорусских рублей 13 копеек", as the prompt asks for it
+def amount_words(value):
+    kopecks = round(value * 100)
+    rubles, kopecks = divmod(kopecks, 100)
+    text = (f"{number_words(rubles)} {plural(rubles, ('белорусский рубль', 'белорусских рубля', 'белорусских рублей'))} "
+            f"{kopecks:02d} {plural(kopecks, ('копейка', 'копейки', 'копеек'))}")
+    return text[0].upper() + text[1:]
+
+
+# the VAT status and amount in words of the prompt, computed from the service rows;
+# ("", "") when an amount is unreadable
+def derived_totals(invoice):
+    with_vat = [amount_value(service.amount_with_vat) for service in invoice.service_details]
+    if not with_vat or None in with_vat:
+        return "", ""
+    words = amount_words(sum(with_vat))
+    rates = {service.vat_rate.strip() for service in invoice.service_details}
+    if rates == {"Без НДС"}:
+        return "Без НДС", words
+    vat = [amount_value(service.vat_amount) for service in invoice.service_details]
+    if len(rates) != 1 or None in vat:
+        return "", words
+    total_vat = sum(vat)
+    return f"НДС {rates.pop()} - {total_vat:.2f} ({amount_words(total_vat)})".replace(".", ","), words
+
+
+# rows where без НДС + НДС doesn't give с НДС or the НДС doesn't follow the rate,
+# a kopeck of rounding aside
+def check_totals(invoice, tolerance=0.011):
+    errors = []
+    for i, service in enumerate(invoice.service_details):
+        without_vat = amount_value(service.amount_without_vat)
+        vat = amount_value(service.vat_amount) or 0.0
+        with_vat = amount_value(service.amount_with_vat)
+        if without_vat is None or with_vat is None:
+            continue
+        if abs(without_vat + vat - with_vat) > tolerance:
+            errors.append(f"service_details.{i}.amount_with_vat")
+        rate = re.fullmatch(r"(\d+(?:[.,]\d+)?)\s*%", service.vat_rate.strip())
+        if rate and abs(without_vat * float(rate.group(1).replace(",", ".")) / 100 - vat) > tolerance:
+            errors.append(f"service_details.{i}.vat_amount")
+    return errors
+
+
+def load_json(json_text):
+    # a single decode; code fences are only stripped when the model added them
+    json_text = json_text.strip()
+    if json_text.startswith("```"):
+        json_text = re.sub(r"^```(?:json)?\s*|\s*```$", "", json_text)
+    return json.loads(json_text)
+
+
+# local: LocalExtract facts, they fill what the model left out; differing values go to the re-ask
+def parse_invoice(json_text, local=None):
+    data = load_json(json_text)
+    if not isinstance(data, dict):
+        raise json.JSONDecodeError("expected a JSON object", json_text, 0)
+    if local:
+        conflicts = local.apply(data)
+        if conflicts:
+            print(f"Warning: model values differ from the invoice text, re-asking: {', '.join(conflicts)}")
+    invoice = Invoice.from_dict(data)
+    return invoice, check_invoice(invoice, local)
+
+
+def check_invoice(invoice, local=None):
+    errors = validate(invoice)
+    if local:
+        errors += [path for path in local.check(invoice) if path not in errors]
+    return errors
+
+
+REASK_PROMPT = """
+    В ранее извлеченных из этого счета данных следующие поля отсутствуют, имеют неверный формат
+    или не совпадают с текстом счета:
+    {fields}
+    Текущие значения: {current}
+    Найди в счете правильные значения только для этих полей и верни JSON-объект той же вложенной
+    структуры, содержащий только эти поля. Форматы: даты ДД.ММ.ГГГГ, УНП - 9 цифр,
+    расчетный счет BYxxxxxxxxxxxxxxxxxxxxxxxxxx, суммы числом с разделителем запятой или "-",
+    период "с ДД.ММ.ГГГГ по ДД.ММ.ГГГГ".
+    """
+
+FIX_JSON_PROMPT = """
+    Следующий ответ должен был быть JSON-объектом, но не разбирается как JSON.
+    Верни те же данные в виде корректного JSON, ничего не меняя в значениях:
+    """
+
+
+def reask_contents(invoice, errors, payload):
+    current = {}
+    for path in errors:
+        try:
+            current[path] = get_field(invoice, path)
+        except (AttributeError, IndexError):
+            current[path] = ""
+    prompt = REASK_PROMPT.format(fields=", ".join(errors), current=json.dumps(current, ensure_ascii=False))
+    return [prompt] + list(payload)
+
+
+# copies the re-asked fields into the invoice, keeping the rest of it untouched
+def merge_fields(invoice, answer, errors):
+    data = invoice.to_dict()
+    for path in errors:
+        source, target = answer, data
+        names = path.split(".")
+        try:
+            for name in names[:-1]:
+                source = source[int(name)] if isinstance(source, list) else source[name]
+                target = target[int(name)] if isinstance(target, list) else target[name]
+            last = names[-1]
+            target[int(last) if isinstance(target, list) else last] = source[int(last) if isinstance(source, list) else last]
+        except (KeyError, IndexError, TypeError, ValueError):
+            continue
+    return Invoice.from_dict(data)
+
+
+# chunks of one document: the first non-empty value of every field; the prompt
+# asks for the one ИТОГО row, so the services come from the last chunk that
+# answered with any (adding up rows of several chunks would overstate the totals)
+def merge_invoices(invoices):
+    merged = Invoice()
+    for invoice in invoices:
+        for f in fields(Invoice):
+            value = getattr(invoice, f.name)
+            if isinstance(value, str):
+                if not getattr(merged, f.name).strip():
+                    setattr(merged, f.name, value)
+            elif f.name != "service_details":
+                target = getattr(merged, f.name)
+                for sub in fields(value):
+                    if not getattr(target, sub.name).strip():
+                        setattr(target, sub.name, getattr(value, sub.name))
+    for invoice in reversed(invoices):
+        if invoice.service_details:
+            merged.service_details = list(invoice.service_details)
+            break
+    return merged
+
+
+# one schema-constrained request, one parse, and at most one targeted re-ask;
+# payload is what follows the prompt (text or page parts), tokens is the
+# estimate passed to the rate limiter; with a ContextCache whose prefix the
+# prompt starts with, only the rest of the prompt is sent; partial answers
+# (a chunk of a document) are not re-asked; returns (dict, parse_path)
+def request_invoice(client, model, prompt, payload, metrics=None, limiter=None, tokens=0, local=None, context=None,
+                    partial=False):
+    def generate(contents, config, request_tokens):
+        if limiter:
+            with timed(metrics, "rate_limit_wait"):
+                limiter.acquire(request_tokens)
+        with timed(metrics, "api"):
+            response = client.models.generate_content(model=model, contents=contents, config=config)
+        if metrics:
+            metrics.record_usage(response)
+        return response
+
+    schema = residual_schema(local.known_paths()) if local else RESPONSE_SCHEMA
+    cache_name = context.name() if context and prompt.startswith(context.prefix) else None
+    config = generation_config(model, schema)
+    if cache_name:
+        try:
+            response = generate([prompt[len(context.prefix):]] + list(payload),
+                                generation_config(model, schema, cache_name), tokens)
+        except Exception as e:
+            if not is_missing_cache(e):
+                raise
+            # expired on the server: send the full prompt this time, the next call recreates it
+            context.invalidate(cache_name)
+            cache_name = None
+    if not cache_name:
+        response = generate([prompt] + list(payload), config, tokens)
+    parse_path = "schema" if supports_schema(model) else "json"
+
+    with timed(metrics, "parse"):
+        try:
+            invoice, errors = parse_invoice(response.text, local)
+        except json.JSONDecodeError:
+            invoice, errors = None, None
+
+    if invoice is None:
+        # broken JSON: a cheap text-only repair request instead of re-sending the pages
+        response = generate([FIX_JSON_PROMPT + response.text], config, len(response.text) // 2)
+        with timed(metrics, "parse"):
+            invoice, errors = parse_invoice(response.text, local)
+        parse_path = "json_repair"
+
+    if partial:
+        return invoice.to_dict(), parse_path
+
+    if errors:
+        response = generate(reask_contents(invoice, errors, payload), generation_config(model, None), tokens)
+        with timed(metrics, "parse"):
+            try:
+                invoice = merge_fields(invoice, load_json(response.text), errors)
+            except json.JSONDecodeError:
+                pass
+            errors = check_invoice(invoice, local)
+        parse_path = "reask"
+
+    if errors:
+        print(f"Warning: invalid fields after re-ask: {', '.join(errors)}")
+        parse_path = "invalid"
+    return invoice.to_dict(), parse_path
@@ -0,0 +1,447 @@
+import argparse
+import base64
+import json
+import os
+import queue
+import signal
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+
+import ThinkingGemini
+from RateLimiter import RateLimiter
+from ResponseCache import ResponseCache
+from PageSelect import pages_option
+from TextExtract import BACKENDS, get_markitdown
+from SpravkaRenderer import get_renderer
+from Metrics import MetricsLog
+from BatchJournal import BatchJournal
+from ApiRetry import AimdController, RetryingClient
+from Engines import ENGINE_NAMES, build_engine
+from BulkExport import BulkExport, formats_option
+from InboxClaims import LEASE_SECONDS, InboxClaims
+
+# seconds a file in the inbox must stay unchanged before it is picked up,
+# so half-written scans are not processed
+SETTLE_SECONDS = 1.0
+
+
+# render processes leave shutdown to the service
+def reset_signals():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+# long-running pipeline: one client, cache, limiter, render pool and parsed
+# template shared by the inbox watcher and the HTTP intake
+class InvoiceService:
+    def __init__(self, args):
+        from concurrent.futures import ProcessPoolExecutor
+        from google import genai
+
+        self.args = args
+        self.limiter = RateLimiter(rpm=args.rpm, tpm=args.tpm)
+        self.client = RetryingClient(genai.Client(api_key=args.key), AimdController(max(1, args.workers)),
+                                     self.limiter, args.max_retries)
+        self.cache = None if args.no_cache else ResponseCache(args.cache_dir)
+        self.render_pool = None
+        if args.engine in ("vision", "cascade"):
+            self.render_pool = ProcessPoolExecutor(max_workers=args.render_workers, initializer=reset_signals)
+        # each engine keeps its instruction block cached on the Gemini side for as long as the service runs
+        self.engine = build_engine(args.engine, self.client, self.limiter, self.cache, args, self.render_pool)
+        self.metrics_log = MetricsLog(args.metrics) if args.metrics else None
+        self.export = BulkExport(args.export, args.export_format, args.export_batch) if args.export else None
+        self.journal = None
+        self.claims = None
+        self.jobs = queue.Queue(maxsize=max(1, args.queue_size))
+        self.stopping = threading.Event()
+        self.wake = threading.Event()
+        self.processed = 0
+        self.failed = 0
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._intake_lock = threading.Lock()
+        self._closed = False
+        self._workers = [threading.Thread(target=self._work, name=f"worker-{n}") for n in range(max(1, args.workers))]
+
+        # warm up what the first request would otherwise pay for
+        get_renderer(args.template)
+        if args.engine in ("text", "cascade") and args.extractor == "markitdown":
+            get_markitdown()
+
+    def start(self):
+        for worker in self._workers:
+            worker.start()
+
+    # blocks while the queue is full unless block is False (then raises queue.Full)
+    def submit(self, pdf_file, output_file, on_done=None, block=True):
+        from concurrent.futures import Future
+        future = Future()
+        with self._intake_lock:
+            if self._closed:
+                raise RuntimeError("service is shutting down")
+            self.jobs.put((pdf_file, output_file, future, on_done), block=block)
+            with self._lock:
+                self._pending += 1
+        return future
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                return
+            pdf_file, output_file, future, on_done = job
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(self.process(pdf_file, output_file))
+                    except Exception as e:
+                        future.set_exception(e)
+                    with self._lock:
+                        if future.exception():
+                            self.failed += 1
+                        else:
+                            self.processed += 1
+                if on_done:
+                    on_done(future)
+            finally:
+                with self._lock:
+                    self._pending -= 1
+                self.jobs.task_done()
+
+    def process(self, pdf_file, output_file):
+        args = self.args
+        metrics = self.metrics_log.document(pdf_file) if self.metrics_log else None
+        analysis_result = self.engine.analyze(pdf_file, metrics)
+        if metrics and not metrics.route:
+            metrics.route = self.engine.name
+
+        if isinstance(analysis_result, str):
+            if self.journal:
+                self.journal.update(pdf_file, "failed", error=analysis_result)
+            if metrics:
+                metrics.finish()
+            raise RuntimeError(analysis_result)
+        data = ThinkingGemini.finish_invoice(pdf_file, analysis_result, output_file, None, args.template, metrics,
+                                             self.journal, self.export)
+        return {"source": os.path.basename(pdf_file), "analysis": analysis_result, "data": data, "output": output_file}
+
+    # inbox: PDFs are claimed into .work/, then moved to processed/ or failed/;
+    # with --shared several services on one or more hosts take turns on the same inbox
+    def watch(self, inbox, output_dir):
+        args = self.args
+        claims = self.claims = InboxClaims(inbox, args.shared, args.worker_id, args.lease)
+        os.makedirs(output_dir, exist_ok=True)
+        if not args.no_journal and (args.journal or not args.shared):
+            self.journal = BatchJournal(args.journal or os.path.join(inbox, ".invoice_journal.sqlite"))
+            if self.export:
+                self.export.on_flush = self.journal.mark_exported
+        elif args.shared and not args.no_journal:
+            # SQLite locking is not reliable on network shares, a shared inbox has no common journal
+            print("Журнал отключен для общей папки; укажите --journal на локальном диске, чтобы вести его.")
+        if args.shared:
+            print(f"Обработчик '{claims.worker_id}' подключен к общей папке '{inbox}'.")
+
+        observer = None
+        try:
+            from watchdog.observers import Observer  # type: ignore
+            from watchdog.events import FileSystemEventHandler  # type: ignore
+
+            wake = self.wake
+
+            class Wake(FileSystemEventHandler):
+                def on_any_event(self, event):
+                    wake.set()
+
+            observer = Observer()
+            observer.schedule(Wake(), inbox, recursive=False)
+            observer.start()
+            print(f"Следим за папкой '{inbox}' (inotify).")
+        except ImportError:
+            print(f"watchdog не установлен, папка '{inbox}' опрашивается каждые {args.poll} с.")
+
+        # files left by a killed run of this worker go first
+        for pdf_file in claims.leftovers():
+            self._enqueue(inbox, output_dir, pdf_file, claims)
+
+        seen = {}  # path -> (size, mtime_ns) of the previous scan
+        while not self.stopping.is_set():
+            claims.recover()
+            now = time.time()
+            current = {}
+            waiting = False
+            for entry in os.scandir(inbox):
+                if not entry.is_file() or not entry.name.lower().endswith(".pdf"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue  # claimed by another worker
+                signature = (stat.st_size, stat.st_mtime_ns)
+                if seen.get(entry.path) == signature and now - stat.st_mtime >= SETTLE_SECONDS:
+                    # claim only what the workers can start on, the rest stays for the other hosts
+                    if self.busy() >= max(1, args.workers) * 2:
+                        waiting = True
+                        current[entry.path] = signature
+                        continue
+                    claimed = claims.claim(entry.path)
+                    if claimed:
+                        self._enqueue(inbox, output_dir, claimed, claims)
+                else:
+                    current[entry.path] = signature
+            seen = current
+            if args.once and not seen and not self.busy():
+                print("Папка пуста, завершаем работу.")
+                self.stopping.set()
+                break
+            # unsettled files are looked at again soon, otherwise wait for an event, a finished job or the next poll
+            self.wake.wait(SETTLE_SECONDS if seen and not waiting else args.poll)
+            self.wake.clear()
+
+        if observer:
+            observer.stop()
+            observer.join()
+
+    # documents queued or being processed
+    def busy(self):
+        with self._lock:
+            return self._pending
+
+    def _enqueue(self, inbox, output_dir, pdf_file, claims):
+        name = os.path.basename(pdf_file)
+        output_file = os.path.join(output_dir, os.path.splitext(name)[0] + ".xlsx")
+        if self.journal:
+            record = self.journal.lookup(self.journal.content_hash(pdf_file))
+            if record and record["stage"] == "done":
+                print(f"'{name}' уже обработан ранее ({record['path']}), пропускаем.")
+                if self.export and record["data"] and not record["exported"]:
+                    # its rows were still buffered when the previous run stopped
+                    self.export.add(pdf_file, record["data"])
+                claims.finish(pdf_file, "processed")
+                return
+            self.journal.start(pdf_file, output_file)
+
+        def on_done(future):
+            claims.finish(pdf_file, "failed" if future.exception() else "processed")
+            if future.exception():
+                print(f"Ошибка обработки '{name}': {future.exception()}")
+            else:
+                print(f"'{name}' обработан, результат: {output_file}")
+            self.wake.set()
+
+        print(f"Новый файл: {name} (в очереди: {self.jobs.qsize()})")
+        self.submit(pdf_file, output_file, on_done)
+
+    def stop(self):
+        self.stopping.set()
+        self.wake.set()
+
+    # lets every queued and running job finish, then releases the shared resources
+    def drain(self):
+        with self._intake_lock:
+            self._closed = True
+            for _ in self._workers:
+                self.jobs.put(None)
+        for worker in self._workers:
+            worker.join()
+        if self.render_pool:
+            self.render_pool.shutdown()
+        if self.claims:
+            self.claims.close()
+        # the export's last flush still marks its documents in the journal
+        if self.export:
+            self.export.close()
+        if self.journal:
+            self.journal.close()
+        self.engine.close()
+        if self.metrics_log:
+            self.metrics_log.print_summary()
+        print(f"Обработано: {self.processed}, с ошибками: {self.failed}.")
+
+
+def make_handler(service):
+    from http.server import BaseHTTPRequestHandler
+
+    class InvoiceHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, body, headers=()):
+            payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if urlparse(self.path).path != "/health":
+                self.send_json(404, {"error": "not found"})
+                return
+            self.send_json(200, {"queued": service.jobs.qsize(), "processed": service.processed,
+                                 "failed": service.failed, "stopping": service.stopping.is_set()})
+
+        # POST /invoice?name=file.pdf[&format=xlsx] with the PDF as the body
+        def do_POST(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            if url.path != "/invoice":
+                self.send_json(404, {"error": "not found"})
+                return
+            if service.stopping.is_set():
+                self.send_json(503, {"error": "shutting down"})
+                return
+            length = int(self.headers.get("Content-Length") or 0)
+            if not length or length > service.args.max_upload_mb * 1024 * 1024:
+                self.send_json(413 if length else 411, {"error": "a PDF body up to "
+                                                                 f"{service.args.max_upload_mb} MB is expected"})
+                return
+            body = self.rfile.read(length)
+            if not body.startswith(b"%PDF"):
+                self.send_json(415, {"error": "not a PDF"})
+                return
+
+            name = os.path.basename(query.get("name", ["upload.pdf"])[0]) or "upload.pdf"
+            with tempfile.TemporaryDirectory(prefix="invoice_") as work_dir:
+                pdf_file = os.path.join(work_dir, name if name.lower().endswith(".pdf") else name + ".pdf")
+                with open(pdf_file, "wb") as f:
+                    f.write(body)
+                output_file = os.path.splitext(pdf_file)[0] + ".xlsx"
+                try:
+                    future = service.submit(pdf_file, output_file, block=False)
+                except queue.Full:
+                    self.send_json(503, {"error": "queue is full"}, [("Retry-After", "5")])
+                    return
+                except RuntimeError as e:
+                    self.send_json(503, {"error": str(e)})
+                    return
+                try:
+                    result = future.result()
+                except Exception as e:
+                    self.send_json(502, {"error": str(e)})
+                    return
+                with open(output_file, "rb") as f:
+                    workbook = f.read()
+
+            if query.get("format", ["json"])[0] == "xlsx":
+                self.send_response(200)
+                self.send_header("Content-Type", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+                self.send_header("Content-Disposition", f'attachment; filename="{os.path.basename(output_file)}"')
+                self.send_header("Content-Length", str(len(workbook)))
+                self.end_headers()
+                self.wfile.write(workbook)
+                return
+            result["output"] = os.path.basename(output_file)
+            result["xlsx_base64"] = base64.b64encode(workbook).decode("ascii")
+            self.send_json(200, result)
+
+        def log_message(self, format, *args):
+            print(f"HTTP {self.address_string()} {format % args}")
+
+    return InvoiceHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Keep the invoice pipeline running: watch an inbox folder and/or accept PDFs over local HTTP.")
+    parser.add_argument("-k", "--key", required=True, help="Your Google Gemini API key.")
+    parser.add_argument("--inbox", default=None, help="Folder scanners drop invoices into.")
+    parser.add_argument("--shared", action="store_true",
+                        help="The inbox is shared by several services (processes or hosts); each claims files for itself.")
+    parser.add_argument("--worker-id", default=None,
+                        help="Name of this service in a shared inbox (default: host name and process id).")
+    parser.add_argument("--lease", type=int, default=LEASE_SECONDS,
+                        help="Seconds without a heartbeat after which a worker's claimed files go back to the shared inbox.")
+    parser.add_argument("--once", action="store_true", help="Exit when the inbox is empty and everything claimed is done.")
+    parser.add_argument("--output-dir", default=None, help="Where справки from the inbox go (default: <inbox>/out).")
+    parser.add_argument("--port", type=int, default=0, help="Local HTTP port (0 - no HTTP intake).")
+    parser.add_argument("--host", default="127.0.0.1", help="HTTP bind address.")
+    parser.add_argument("--engine", choices=ENGINE_NAMES, default="cascade",
+                        help="text - extracted text to the fast model, vision - page images to the thinking model, "
+                             "layout - learned vendor layouts without a model call, "
+                             "cascade - layout, then text, then vision, each only when the previous answer fails validation.")
+    parser.add_argument("--templates-dir", default=".layout_templates",
+                        help="Where the cascade keeps the learned layouts of recurring vendors.")
+    parser.add_argument("--no-templates", action="store_true", help="Don't read or learn vendor layouts in the cascade.")
+    parser.add_argument("--extractor", choices=sorted(BACKENDS), default="fitz",
+                        help="Text extraction backend of the text engine.")
+    parser.add_argument("-p", "--pages", type=pages_option, default="auto",
+                        help="Pages sent to the model: auto, all or N leading pages.")
+    parser.add_argument("-w", "--workers", type=int, default=2, help="Number of documents processed concurrently.")
+    parser.add_argument("--queue-size", type=int, default=32, help="Max documents waiting for a worker.")
+    parser.add_argument("--poll", type=float, default=5.0, help="Inbox polling interval without inotify, seconds.")
+    parser.add_argument("--max-upload-mb", type=int, default=50, help="Max size of an uploaded PDF.")
+    parser.add_argument("--rpm", type=int, default=6, help="Max requests per minute (0 - no limit).")
+    parser.add_argument("--tpm", type=int, default=0, help="Max tokens per minute (0 - no limit).")
+    parser.add_argument("--max-retries", type=int, default=5, help="Retries of a request after 429/5xx and network errors.")
+    parser.add_argument("--render-workers", type=int, default=None, help="Number of processes rendering pages.")
+    parser.add_argument("--memory-cap", type=int, default=64,
+                        help="MB of page images one document may hold in memory, the rest is spooled (0 - no limit).")
+    parser.add_argument("--spool-dir", default=None, help="Directory for spooled page images (default: system temp).")
+    parser.add_argument("--upload-pages", action="store_true",
+                        help="Send documents over the memory cap through the Gemini files API instead of in chunks.")
+    parser.add_argument("--keep-all-pages", action="store_true",
+                        help="Upload blank and repeated pages too (by default they are left out before rendering).")
+    parser.add_argument("--dpi", type=int, default=72, help="Page render resolution.")
+    parser.add_argument("--color", choices=["rgb", "gray", "bw"], default="rgb", help="Page image color mode.")
+    parser.add_argument("--format", choices=["png", "jpeg", "webp"], default="png", help="Page image encoding.")
+    parser.add_argument("--quality", type=int, default=85, help="JPEG/WebP quality.")
+    parser.add_argument("--max-dim", type=int, default=0, help="Max page image side in pixels (0 - no limit).")
+    parser.add_argument("--template", default=None, help="Template workbook of the справка.")
+    parser.add_argument("--export", default=None, help="Directory to append invoices and service lines to as flat files.")
+    parser.add_argument("--export-format", type=formats_option, default=["jsonl", "csv"],
+                        help="Comma-separated export formats: jsonl, csv, parquet (needs pyarrow).")
+    parser.add_argument("--export-batch", type=int, default=200, help="Invoices buffered before the export files are written.")
+    parser.add_argument("--metrics", default=None, help="Append per-document metrics to this JSONL file.")
+    parser.add_argument("--journal", default=None, help="Journal of inbox files (default: <inbox>/.invoice_journal.sqlite).")
+    parser.add_argument("--no-journal", action="store_true", help="Don't keep a journal of inbox files.")
+    parser.add_argument("--no-context-cache", action="store_true", help="Don't cache the instruction block on the Gemini side.")
+    parser.add_argument("--context-ttl", type=int, default=3600, help="Lifetime of the cached instruction block, seconds.")
+    parser.add_argument("--cache-dir", default=".gemini_cache", help="Directory of the model response cache.")
+    parser.add_argument("--no-cache", action="store_true", help="Don't read or write cached model responses.")
+    args = parser.parse_args()
+
+    if args.pages == "ask":
+        parser.error("--pages ask is not available in service mode")
+    if not args.inbox and not args.port:
+        parser.error("nothing to do: pass --inbox and/or --port")
+    if (args.shared or args.once) and not args.inbox:
+        parser.error("--shared and --once need --inbox")
+    if args.inbox and not os.path.isdir(args.inbox):
+        print(f"Error: Inbox '{args.inbox}' is not a directory.")
+        return
+
+    service = InvoiceService(args)
+    service.start()
+
+    # SIGTERM and Ctrl+C stop the intake, queued and running jobs still finish
+    def shutdown(signum, frame):
+        print("\nОстанавливаемся, дожидаемся документов в работе...")
+        service.stop()
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    server = None
+    if args.port:
+        from http.server import ThreadingHTTPServer
+        server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+        server.daemon_threads = False  # server_close() waits for the requests being answered
+        threading.Thread(target=server.serve_forever, name="http", daemon=True).start()
+        print(f"HTTP: POST http://{args.host}:{server.server_address[1]}/invoice")
+
+    if args.inbox:
+        service.watch(args.inbox, args.output_dir or os.path.join(args.inbox, "out"))
+    else:
+        service.stopping.wait()
+
+    if server:
+        server.shutdown()
+    service.drain()
+    if server:
+        server.server_close()
+    print("Сервис остановлен.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,390 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from dataclasses import fields
+
+from InvoiceSchema import (Client, Director, DocumentInfo, Executor, Invoice, amount_value, check_totals,
+                           derived_totals, validate)
+from LocalExtract import AMOUNT, TOTAL_ROW, scan
+from TextExtract import CELL_GAP, page_text
+
+# layouts of recurring vendors, keyed by executor УНП: where every field of a
+# validated answer sits on the page, so the next invoice of the same vendor is
+# read from word boxes without a model call
+
+# points a label, a value or a table row may move before the layout counts as changed
+DRIFT = 6
+# share of the labels that must be found in place
+MIN_LANDMARKS = 0.9
+# a layout with fewer fixed labels can't be told apart from another one
+MIN_LANDMARK_COUNT = 2
+# layouts kept per vendor, the most recently learned first
+MAX_LAYOUTS = 3
+
+SCALAR_PATHS = ([f"{group}.{f.name}" for group, record_cls in (("document_info", DocumentInfo), ("executor", Executor),
+                                                                ("client", Client), ("director", Director))
+                 for f in fields(record_cls)]
+                + ["service_period", "total_amount_words", "vat_status"])
+# fields that don't change between invoices of one vendor; only these may be kept
+# as learned when the page doesn't print them the way the model wrote them
+CONSTANT_PATHS = {"document_info.document_name", "document_info.contract_info", "executor.company_name",
+                  "executor.address", "executor.bank_account", "executor.bank_name", "client.company_name",
+                  "client.address", "client.unp", "director.company_name", "director.position", "director.full_name"}
+# written by the model from the service row when the page doesn't print them;
+# computed from the row read off the new invoice the same way
+DERIVED_PATHS = ("vat_status", "total_amount_words")
+CELLS = ("service_name", "amount_without_vat", "vat_rate", "vat_amount", "amount_with_vat")
+
+PUNCTUATION = "\"'«»“”„,;:()"
+
+
+def norm(word):
+    return word.strip(PUNCTUATION).lower()
+
+
+def centre(word):
+    return (word[1] + word[3]) / 2
+
+
+def page_words(page):
+    # (x0, y0, x1, y1, text, block, line, word) in block order, so wrapped values stay contiguous
+    return page.get_text("words")
+
+
+# indexes of the words that spell value, or None; spaces don't count,
+# so "1290,50" is found as "1 290,50" and the other way round
+def find_value(words, value):
+    target = "".join(norm(token) for token in value.split())
+    if not target:
+        return None
+    texts = [norm(word[4]) for word in words]
+    for i in range(len(words)):
+        spelled = ""
+        for j in range(i, len(words)):
+            spelled += texts[j]
+            if spelled == target:
+                return list(range(i, j + 1))
+            if not texts[j] or not target.startswith(spelled):
+                break
+    return None
+
+
+def union_box(words):
+    return [min(w[0] for w in words), min(w[1] for w in words), max(w[2] for w in words), max(w[3] for w in words)]
+
+
+# words with their centre between top and bottom, as visual lines sorted left to right
+def lines_between(words, top, bottom):
+    lines = []
+    for word in sorted((w for w in words if top <= centre(w) <= bottom), key=lambda w: (centre(w), w[0])):
+        if lines and abs(centre(lines[-1][0]) - centre(word)) <= (word[3] - word[1]) / 2:
+            lines[-1].append(word)
+        else:
+            lines.append([word])
+    return [sorted(line) for line in lines]
+
+
+# text inside box on the new page: values grow to either side until a wider
+# gap or one of the labels that bordered them when the layout was learned
+def gather(words, box, stops=()):
+    x0, top, x1, bottom = box
+    stops = {norm(stop) for stop in stops if stop}
+    parts = []
+    for line in lines_between(words, top - DRIFT, bottom + DRIFT):
+        seeds = [i for i, w in enumerate(line) if w[2] > x0 - DRIFT and w[0] < x1 + DRIFT and norm(w[4]) not in stops]
+        if not seeds:
+            continue
+        start, end = seeds[0], seeds[0]
+        while end + 1 < len(line) and norm(line[end + 1][4]) not in stops and \
+                (end + 1 in seeds or line[end + 1][0] - line[end][2] < CELL_GAP):
+            end += 1
+        while start > 0 and norm(line[start - 1][4]) not in stops and line[start][0] - line[start - 1][2] < CELL_GAP:
+            start -= 1
+        parts.append(" ".join(w[4] for w in line[start:end + 1]))
+    return " ".join(parts)
+
+
+# the first page is counted from the start, the others from the end, so a bill
+# with more detail pages this month still has its ИТОГО page where it was
+def page_key(page, page_count):
+    return page if page == 0 else page - page_count
+
+
+# how many pages a document needs for the pages a layout uses
+def pages_needed(pages):
+    return max((p + 1 for p in pages if p >= 0), default=0) + max((-p for p in pages if p < 0), default=0)
+
+
+def get_path(data, path):
+    group, _, name = path.rpartition(".")
+    values = data.get(group) if group else data
+    return str((values or {}).get(name) or "") if isinstance(values, dict) else ""
+
+
+def set_path(data, path, value):
+    group, _, name = path.rpartition(".")
+    (data.setdefault(group, {}) if group else data)[name] = value
+
+
+# table rows below the learned first row: a row is a band with an amount in the
+# "с НДС" column, the table ends at ИТОГО/Всего or at the first band without one
+def table_rows(words, rows):
+    x0, x1 = rows["cells"]["amount_with_vat"]["box"][0], rows["cells"]["amount_with_vat"]["box"][2]
+    top = rows["top"] - DRIFT
+    column = [w for w in words if centre(w) >= top and w[2] > x0 - DRIFT and w[0] < x1 + DRIFT]
+    bands = []
+    end = None
+    for line in lines_between(column, top, float("inf")):
+        band_top, band_bottom = min(w[1] for w in line), max(w[3] for w in line)
+        full_line = lines_between(words, band_top, band_bottom)
+        first = full_line[0][0][4] if full_line else ""
+        if TOTAL_ROW.match(first) or not AMOUNT.fullmatch(" ".join(w[4] for w in line)):
+            end = band_top
+            break
+        bands.append((band_top, band_bottom))
+    return bands, end
+
+
+class LayoutTemplates:
+    def __init__(self, template_dir=".layout_templates"):
+        self.template_dir = template_dir
+        self._templates = {}
+        self._lock = threading.Lock()
+        os.makedirs(template_dir, exist_ok=True)
+
+    def _path(self, unp):
+        return os.path.join(self.template_dir, unp + ".json")
+
+    def _load(self, unp):
+        if unp not in self._templates:
+            try:
+                with open(self._path(unp), encoding="utf-8") as f:
+                    self._templates[unp] = json.load(f)
+            except (OSError, ValueError):
+                self._templates[unp] = []
+        return self._templates[unp]
+
+    # the learned layouts of the vendor, possibly none
+    def get(self, unp):
+        with self._lock:
+            return self._load(unp)
+
+    def put(self, template):
+        with self._lock:
+            # a vendor with a second layout (another branch, a new form) doesn't wipe the first one
+            layouts = [template] + self._load(template["unp"])[:MAX_LAYOUTS - 1]
+            fd, tmp_path = tempfile.mkstemp(dir=self.template_dir, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(layouts, f, ensure_ascii=False, indent=1)
+            os.replace(tmp_path, self._path(template["unp"]))
+            self._templates[template["unp"]] = layouts
+
+    # records the layout of a validated answer; returns why it could not, or ""
+    def learn(self, pdf_file, analysis_result):
+        import fitz
+        invoice = Invoice.from_dict(analysis_result)
+        unp = invoice.executor.unp.strip()
+        if validate(invoice) or check_totals(invoice):
+            return "answer not validated"
+        data = invoice.to_dict()
+        doc = fitz.open(pdf_file)
+        try:
+            words = [page_words(page) for page in doc]
+            sizes = [[round(page.rect.width), round(page.rect.height)] for page in doc]
+            text = "\n\n".join(page_text(page) for page in doc)
+        finally:
+            doc.close()
+        local = scan(text).to_dict()
+
+        template = {"unp": unp, "pages": len(words), "sizes": {}, "fields": {}, "landmarks": [],
+                    "learned": time.strftime("%Y-%m-%dT%H:%M:%S")}
+        value_words = set()
+        for path in SCALAR_PATHS:
+            value = get_path(data, path)
+            if not value:
+                continue
+            for page, page_list in enumerate(words):
+                found = find_value(page_list, value)
+                if found:
+                    matched = [page_list[i] for i in found]
+                    line = [w for w in page_list if w[5:7] == matched[0][5:7]]
+                    before = [w[4] for w in line if w[7] == matched[0][7] - 1]
+                    after = [w[4] for w in line if w[7] == matched[-1][7] + 1]
+                    template["fields"][path] = {"source": "box", "page": page_key(page, len(words)),
+                                                "box": union_box(matched),
+                                                "before": before[0] if before else "",
+                                                "after": after[0] if after else ""}
+                    value_words.update((page, i) for i in found)
+                    break
+            else:
+                # derived by the model (e.g. "Бухгалтерская справка № Б.Н."): the regular
+                # expressions give it again, it doesn't change between invoices, or it
+                # is computed from the service row; anything else would be copied wrong
+                if get_path(local, path) == value:
+                    template["fields"][path] = {"source": "local"}
+                elif path in CONSTANT_PATHS:
+                    template["fields"][path] = {"source": "constant", "value": value}
+                elif path in DERIVED_PATHS:
+                    template["fields"][path] = {"source": "derived"}
+                else:
+                    return f"{path} not printed as returned"
+
+        rows = self._learn_rows(words, invoice.service_details[0])
+        if not rows:
+            return "service row not printed as returned"
+        rows["end"] = table_rows(words[rows["page"]], rows)[1]
+        rows["page"] = page_key(rows["page"], len(words))
+        template["rows"] = rows
+
+        # labels that start the lines holding values; they don't move while the layout stays the same
+        for page, page_list in enumerate(words):
+            lines = {w[5:7] for i, w in enumerate(page_list) if (page, i) in value_words}
+            for i, w in enumerate(page_list):
+                if w[5:7] in lines and w[7] == 0 and (page, i) not in value_words and norm(w[4]):
+                    template["landmarks"].append({"page": page_key(page, len(words)), "text": w[4],
+                                                  "at": [w[0], w[1]]})
+        if len(template["landmarks"]) < MIN_LANDMARK_COUNT:
+            return "too few fixed labels on the page"
+        if any(template["fields"].get(path, {}).get("source") != "box"
+               for path in ("executor.unp", "document_info.document_number", "document_info.document_date")):
+            return "number, date or УНП not printed as returned"
+        # only the pages that hold fields and rows have to match later
+        for page in self._pages(template):
+            template["sizes"][str(page)] = sizes[page]
+        self.put(template)
+        return ""
+
+    @staticmethod
+    def _learn_rows(words, service):
+        for page, page_list in enumerate(words):
+            found = find_value(page_list, service.service_name)
+            if not found:
+                continue
+            name_words = [page_list[i] for i in found]
+            top, bottom = min(w[1] for w in name_words), max(w[3] for w in name_words)
+            line = [w for line in lines_between(page_list, top, bottom) for w in line]
+            cells = {"service_name": {"box": union_box(name_words)}}
+            right_of = name_words[-1][2]
+            for name in CELLS[1:]:
+                value = getattr(service, name)
+                candidates = [w for w in line if w[0] >= right_of]
+                hit = find_value(candidates, value)
+                if hit:
+                    cells[name] = {"box": union_box([candidates[i] for i in hit])}
+                    right_of = candidates[hit[-1]][2]
+                elif amount_value(value) is None:
+                    cells[name] = {"value": value}  # e.g. "-" in the НДС column printed as a dash of another kind
+                else:
+                    return None  # an amount must come from the page, never from the learned invoice
+            if "box" in cells["amount_with_vat"]:
+                return {"page": page, "top": top, "cells": cells}
+        return None
+
+    # the invoice read from the learned layout, or an error string when there
+    # is no template or the layout has drifted
+    def extract(self, pdf_file):
+        import fitz
+        doc = fitz.open(pdf_file)
+        try:
+            text = "\n\n".join(page_text(page) for page in doc)
+            facts = scan(text)
+            candidates = [facts.fields.get("executor.unp")] + sorted(facts.unps)
+            layouts = next((self.get(unp) for unp in candidates if unp and self.get(unp)), [])
+            if not layouts:
+                return "Error: no layout template for the vendor"
+            words = [page_words(page) for page in doc]
+            sizes = [[round(page.rect.width), round(page.rect.height)] for page in doc]
+        finally:
+            doc.close()
+
+        errors = []
+        for template in layouts:
+            result = self._read(template, words, sizes, facts)
+            if not isinstance(result, str):
+                return result
+            errors.append(result)
+        return errors[0]
+
+    @staticmethod
+    def _pages(template):
+        return ({spec["page"] for spec in template["fields"].values() if "page" in spec}
+                | {mark["page"] for mark in template["landmarks"]} | {template["rows"]["page"]})
+
+    @staticmethod
+    def _read(template, words, sizes, facts):
+        if not isinstance(template["sizes"], dict):
+            return "Error: layout template of an older version"
+        if len(words) < pages_needed(LayoutTemplates._pages(template)) or \
+                any(sizes[int(page)] != size for page, size in template["sizes"].items()):
+            return "Error: layout changed (page count or size)"
+        rows = template["rows"]
+        page_list = words[rows["page"]]
+        bands, end = table_rows(page_list, rows)
+        if not bands or abs(bands[0][0] - rows["cells"]["amount_with_vat"]["box"][1]) > DRIFT:
+            return "Error: layout changed (service table moved)"
+        # everything below the table moves with the number of its rows
+        growth = end - rows["end"] if end is not None and rows["end"] is not None else 0
+
+        def offset(page, y):
+            return growth if page == rows["page"] and y > rows["top"] + DRIFT else 0
+
+        def in_place(mark):
+            x, y = mark["at"][0], mark["at"][1] + offset(mark["page"], mark["at"][1])
+            return any(w[4] == mark["text"] and abs(w[0] - x) <= DRIFT and abs(w[1] - y) <= DRIFT
+                       for w in words[mark["page"]])
+
+        found = sum(1 for mark in template["landmarks"] if in_place(mark))
+        if found < MIN_LANDMARKS * len(template["landmarks"]):
+            return f"Error: layout changed ({found}/{len(template['landmarks'])} labels in place)"
+
+        local = facts.to_dict()
+        data = {}
+        for path, spec in template["fields"].items():
+            if spec["source"] == "box":
+                x0, top, x1, bottom = spec["box"]
+                moved = offset(spec["page"], top)
+                box = [x0, top + moved, x1, bottom + moved]
+                value = gather(words[spec["page"]], box, (spec["before"], spec["after"]))
+            elif spec["source"] == "local":
+                value = get_path(local, path)
+            elif spec["source"] == "derived":
+                continue  # needs the service rows
+            else:
+                value = spec["value"]
+            if not value:
+                return f"Error: layout changed ({path} is empty)"
+            set_path(data, path, value)
+
+        services = []
+        for n, (top, bottom) in enumerate(bands):
+            # a long service name may wrap onto the lines below its amounts
+            name_bottom = (bands[n + 1][0] if n + 1 < len(bands) else end or bottom) - DRIFT
+            service = {}
+            for name, spec in rows["cells"].items():
+                if "value" in spec:
+                    service[name] = spec["value"]
+                    continue
+                x0, _, x1, _ = spec["box"]
+                service[name] = gather(page_list, [x0, top, x1, max(bottom, name_bottom) if name == "service_name"
+                                                   else bottom])
+            services.append(service)
+        data["service_details"] = services
+        vat_status, total_words = derived_totals(Invoice.from_dict(data))
+        for path, value in zip(DERIVED_PATHS, (vat_status, total_words)):
+            # a value printed on this invoice comes in with the text layer facts below
+            if template["fields"].get(path, {}).get("source") == "derived" and not get_path(local, path):
+                if not value:
+                    return f"Error: layout changed ({path} is empty)"
+                set_path(data, path, value)
+
+        # the regular fields of the text layer must agree with what the boxes gave
+        conflicts = facts.apply(data)
+        invoice = Invoice.from_dict(data)
+        errors = conflicts or validate(invoice) or check_totals(invoice)
+        if invoice.executor.unp != template["unp"]:
+            errors = ["executor.unp"]
+        if errors:
+            return "Error: layout changed (" + ", ".join(errors) + ")"
+        return invoice.to_dict()
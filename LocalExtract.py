@@ -0,0 +1,287 @@
+import json
+import re
+
+from InvoiceSchema import SPRAVKA_FIELDS, Invoice, derived_totals, get_field, validate
+
+# regular fields of Belarusian invoices that don't need the model
+UNP = re.compile(r"\bУНП\s*:?\s*(\d{9})\b", re.IGNORECASE)
+IBAN = re.compile(r"\bBY\s?\d{2}(?:\s?[A-Z0-9]{4}){6}\b")
+BIC = re.compile(r"\b([A-Z]{4}BY[A-Z0-9]{2}(?:[A-Z0-9]{3})?)\b")
+DATE = re.compile(r"\b\d{2}\.\d{2}\.\d{4}\b")
+NUMBER = re.compile(r"\bсч[её]т(?:\s*-\s*фактура)?\s*№\s*([\w/-]+)(?:\s+от\s+(\d{2}\.\d{2}\.\d{4}))?", re.IGNORECASE)
+CONTRACT = re.compile(r"\bпо\s+договору\s*№\s*([\w/.-]+)\s+от\s+(\d{2}\.\d{2}\.\d{4})", re.IGNORECASE)
+PERIOD = re.compile(r"\bс\s+(\d{2}\.\d{2}\.\d{4})\s+по\s+(\d{2}\.\d{2}\.\d{4})", re.IGNORECASE)
+SPRAVKA = re.compile(r"бухгалтерская\s+справка\s*№\s*(\S+)", re.IGNORECASE)
+ADDRESS = re.compile(r"^\s*(?:юридический\s+|почтовый\s+)?адрес\s*:\s*(.+)$", re.IGNORECASE)
+# the bank follows the account: "р/с BY.. в ОАО 'Банк' BICCODE"
+BANK = re.compile(r"^\s*в\s+(.+?\s[A-Z]{4}BY[A-Z0-9]{2}(?:[A-Z0-9]{3})?)\b")
+# the client's representative, only on a line that names the client
+CLIENT_LINE = re.compile(r"заказчик|плательщик|покупател", re.IGNORECASE)
+REPRESENTATIVE = re.compile(r"((?i:генеральный\s+директор|директор|руководитель|управляющий))[\s_.:]*"
+                            r"([А-ЯЁ]\.\s?[А-ЯЁ]\.\s?[А-ЯЁ][а-яё-]+)")
+IN_WORDS = re.compile(r"(?:прописью|к оплате)\s*:\s*([А-Яа-яЁё][А-Яа-яЁё ,]*рубл[А-Яа-яЁё ,\d]*)", re.IGNORECASE)
+
+# a role cue switches the state machine: УНП, р/с and names below it belong to that party
+ROLES = [("executor", re.compile(r"\b(исполнитель|поставщик|получатель платежа)\b", re.IGNORECASE)),
+         ("client", re.compile(r"\b(заказчик|плательщик|покупатель)\b", re.IGNORECASE))]
+COMPANY = re.compile(r"^\s*(?:исполнитель|поставщик|заказчик|плательщик|покупатель)\s*:\s*"
+                     r"((?:ООО|ОАО|ЗАО|ОДО|ЧУП|ЧТУП|УП|РУП|СООО|ИООО|ИП)\b[^,]*)", re.IGNORECASE)
+AMOUNT = re.compile(r"-|\d[\d ]*(?:[.,]\d{1,2})?")
+TOTAL_ROW = re.compile(r"^\s*(итого|всего)\b", re.IGNORECASE)
+
+# label words left on a line once its known values are removed
+LABELS = re.compile(r"\b(унп|р/с|расч[её]тный сч[её]т|bic|бик|от|по договору|период|с|по|исполнитель|"
+                    r"заказчик|поставщик|плательщик|сч[её]т|№)\b|[:.,№]", re.IGNORECASE)
+
+
+def format_iban(value):
+    value = value.replace(" ", "")
+    return " ".join(value[i:i + 4] for i in range(0, len(value), 4))
+
+
+# "220030, Минская обл., г. Минск, ул. Энгельса, 6, УНП 100289066" -> "г. Минск, ул. Энгельса, 6"
+def format_address(value):
+    value = re.split(r",?\s*\bУНП\b", value, flags=re.IGNORECASE)[0]
+    parts = [part.strip() for part in value.split(",")]
+    return ", ".join(part for part in parts if part and not re.fullmatch(r"\d{6}", part)
+                     and not re.search(r"обл\b|област|р-н|район|беларусь", part, re.IGNORECASE))
+
+
+def format_amount(value):
+    return value.replace(" ", "").replace(".", ",")
+
+
+def vat_rate(value):
+    value = value.strip()
+    if value in ("-", "0", "0%", "0,00") or "без" in value.lower():
+        return "Без НДС"
+    return value if value.endswith("%") else value + "%"
+
+
+# 5-cell " | " rows of TextExtract between the table header and ИТОГО
+def parse_services(lines):
+    services = []
+    for line in lines:
+        cells = [cell.strip() for cell in line.split(" | ")]
+        if TOTAL_ROW.match(line) and services:
+            break
+        if len(cells) != 5 or not all(AMOUNT.fullmatch(cells[i]) for i in (1, 3, 4)):
+            continue
+        rate = vat_rate(cells[2])
+        services.append({"service_name": cells[0], "amount_without_vat": format_amount(cells[1]), "vat_rate": rate,
+                         "vat_amount": "-" if rate == "Без НДС" else format_amount(cells[3]),
+                         "amount_with_vat": format_amount(cells[4])})
+    return services
+
+
+class LocalFacts:
+    def __init__(self, fields, unps, ibans, bics, dates, services, amount_words):
+        self.fields = fields  # "group.field" -> value, as sure as the text layer
+        self.unps = unps
+        self.ibans = ibans
+        self.bics = bics
+        self.dates = dates
+        self.services = services
+        self.amount_words = amount_words
+
+    # the local table stands in for the model's row only when it is a single line;
+    # with detail lines the model picks the ИТОГО summary the prompt asks for
+    def summary_services(self):
+        return self.services if len(self.services) == 1 else []
+
+    def to_dict(self):
+        data = {}
+        for path, value in self.fields.items():
+            group, _, name = path.rpartition(".")
+            (data.setdefault(group, {}) if group else data)[name] = value
+        if self.summary_services():
+            data["service_details"] = self.summary_services()
+        if self.amount_words:
+            data["total_amount_words"] = self.amount_words
+        if self.services and all(s["vat_rate"] == "Без НДС" for s in self.services):
+            data["vat_status"] = "Без НДС"
+        if self.summary_services():
+            # the printed amount in words wins over the one spelled out from the row
+            vat_status, words = derived_totals(Invoice.from_dict({"service_details": self.summary_services()}))
+            for path, value in (("vat_status", vat_status), ("total_amount_words", words)):
+                if value:
+                    data.setdefault(path, value)
+        return data
+
+    def known_paths(self):
+        paths = []
+        for key, value in self.to_dict().items():
+            if isinstance(value, dict):
+                paths += [f"{key}.{name}" for name in value]
+            else:
+                paths.append(key)
+        return paths
+
+    # every field the справка shows is in the text: no model call at all;
+    # otherwise the model is asked for the rest
+    def complete(self):
+        invoice = Invoice.from_dict(self.to_dict())
+        return not validate(invoice) and all(get_field(invoice, path).strip() for path in SPRAVKA_FIELDS)
+
+    # "path" -> value of everything the text gives; the amounts of the single
+    # table row as service_details.0.*, its name is the model's to generalize
+    def flat(self):
+        values = {}
+        for key, value in self.to_dict().items():
+            if key == "service_details":
+                values.update({f"service_details.0.{name}": cell for name, cell in value[0].items()
+                               if name != "service_name"})
+            elif isinstance(value, dict):
+                values.update({f"{key}.{name}": local for name, local in value.items()})
+            else:
+                values[key] = value
+        return values
+
+    # paths where the model gave a value other than the text's
+    def differences(self, data):
+        return [path for path, local in self.flat().items()
+                if lookup(data, path) and normalize(lookup(data, path)) != normalize(local)]
+
+    # fills in what the model left out (it is told these fields are known) and puts
+    # matching values in the local format; values it gave differently are kept for
+    # the targeted re-ask, returns their paths
+    def apply(self, data):
+        services = self.summary_services()
+        if services and not data.get("service_details"):
+            data["service_details"] = [dict(service) for service in services]
+        for path, value in self.flat().items():
+            if normalize(lookup(data, path)) in ("", normalize(value)):
+                store(data, path, value)
+        return self.differences(data)
+
+    # model values that are absent from the text; they go into the targeted re-ask
+    def check(self, invoice):
+        errors = []
+        for path, candidates in (("executor.unp", self.unps), ("client.unp", self.unps),
+                                 ("document_info.document_date", self.dates)):
+            group, name = path.split(".")
+            value = getattr(getattr(invoice, group), name).strip()
+            if value and candidates and value not in candidates:
+                errors.append(path)
+        account = invoice.executor.bank_account.replace(" ", "")
+        if account and self.ibans and account not in self.ibans:
+            errors.append("executor.bank_account")
+        bank = invoice.executor.bank_name.upper()
+        if bank and self.bics and not any(bic in bank for bic in self.bics):
+            errors.append("executor.bank_name")
+        errors += [path for path in self.differences(invoice.to_dict()) if path not in errors]
+        return errors
+
+    # a short note for the prompt, so the model doesn't search for these again
+    def prompt_note(self):
+        known = self.to_dict()
+        if not known:
+            return ""
+        return ("\n    Эти поля уже извлечены из текста, их возвращать не нужно: "
+                + json.dumps(known, ensure_ascii=False) + "\n")
+
+    # drops lines that carry nothing but already known values and their labels
+    def trim(self, text):
+        known = {v for v in self.fields.values() if v}
+        values = sorted(known, key=len, reverse=True)
+        kept = []
+        for line in text.split("\n"):
+            rest = line
+            for pattern in (NUMBER, CONTRACT, PERIOD):
+                rest = pattern.sub(" ", rest)
+            rest = UNP.sub(lambda m: " " if m.group(1) in known else m.group(0), rest)
+            rest = IBAN.sub(lambda m: " " if format_iban(m.group(0)) in known else m.group(0), rest)
+            for value in values:
+                rest = rest.replace(value, " ")
+            rest = LABELS.sub(" ", rest)
+            # role lines stay: the model still needs to know whose address follows
+            if re.search(r"\w{3,}", rest) or not line.strip() or any(cue.search(line) for _, cue in ROLES):
+                kept.append(line)
+        return "\n".join(kept)
+
+
+def normalize(value):
+    return re.sub(r"[\s\"'«»“”„]+", "", str(value)).lower()
+
+
+def lookup(data, path):
+    value = data
+    for name in path.split("."):
+        if isinstance(value, list):
+            value = value[int(name)] if int(name) < len(value) else None
+        elif isinstance(value, dict):
+            value = value.get(name)
+        else:
+            return ""
+    return str(value or "")
+
+
+def store(data, path, value):
+    names = path.split(".")
+    target = data
+    for name in names[:-1]:
+        if isinstance(target, list):
+            if int(name) >= len(target):
+                return
+            target = target[int(name)]
+        else:
+            if not isinstance(target.get(name), (dict, list)):
+                target[name] = {}
+            target = target[name]
+    if isinstance(target, dict):
+        target[names[-1]] = value
+
+
+def scan(text):
+    fields = {}
+    unps, ibans, bics, dates = set(), set(), set(), set()
+    role = None
+    lines = text.split("\n")
+    for line in lines:
+        # the last role cue of the line decides who the following values belong to
+        cues = [(match.start(), name) for name, cue in ROLES for match in cue.finditer(line)]
+        if cues:
+            role = max(cues)[1]
+        company = COMPANY.match(line)
+        if company and role:
+            fields.setdefault(f"{role}.company_name", company.group(1).strip())
+        address = ADDRESS.match(line)
+        if address and role:
+            fields.setdefault(f"{role}.address", format_address(address.group(1)))
+        representative = REPRESENTATIVE.search(line)
+        if representative and role == "client" and CLIENT_LINE.search(line):
+            fields.setdefault("director.position", representative.group(1).capitalize())
+            fields.setdefault("director.full_name", representative.group(2).replace(" ", ""))
+        for match in UNP.finditer(line):
+            unps.add(match.group(1))
+            if role:
+                fields.setdefault(f"{role}.unp", match.group(1))
+        for match in IBAN.finditer(line):
+            ibans.add(match.group(0).replace(" ", ""))
+            if role in (None, "executor"):
+                fields.setdefault("executor.bank_account", format_iban(match.group(0)))
+                bank = BANK.match(line[match.end():])
+                if bank:
+                    name = re.sub(r"\b(?:BIC|БИК)\s*:?\s*", "", bank.group(1), flags=re.IGNORECASE)
+                    fields.setdefault("executor.bank_name", " ".join(name.split()))
+        bics.update(BIC.findall(line))
+        dates.update(DATE.findall(line))
+
+    if "director.full_name" in fields and "client.company_name" in fields:
+        fields["director.company_name"] = fields["client.company_name"]
+    number = NUMBER.search(text)
+    if number:
+        fields["document_info.document_number"] = f"счет № {number.group(1)}"
+        if number.group(2):
+            fields["document_info.document_date"] = number.group(2)
+    spravka = SPRAVKA.search(text)
+    fields["document_info.document_name"] = f"Бухгалтерская справка № {spravka.group(1) if spravka else 'Б.Н.'}"
+    contract = CONTRACT.search(text)
+    if contract:
+        fields["document_info.contract_info"] = f"по договору № {contract.group(1)} от {contract.group(2)}"
+    period = PERIOD.search(text)
+    if period:
+        fields["service_period"] = f"с {period.group(1)} по {period.group(2)}"
+    words = IN_WORDS.search(text)
+    return LocalFacts(fields, unps, ibans, bics, dates, parse_services(lines),
+                      words.group(1).strip(" ,") if words else "")
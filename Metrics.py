@@ -0,0 +1,154 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+def timed(metrics, name):
+    return metrics.stage(name) if metrics else contextlib.nullcontext()
+
+
+# per-document record: stage timings, payload size, token usage and which
+# branch of the response parser succeeded
+class DocumentMetrics:
+    def __init__(self, source, log=None):
+        self.source = source
+        self._log = log
+        self.stages = {}
+        self.pages = 0
+        self.payload_bytes = 0
+        self.pages_skipped = 0  # blank and repeated pages left out before upload
+        self.bytes_saved = 0  # their estimated upload size
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+        self.total_tokens = 0
+        self.cached_tokens = 0  # prompt tokens served from the context cache
+        self.parse_path = ""  # cache, journal, layout, local, schema, json, json_repair, reask, chunks, invalid, pack or failed
+        self.route = ""  # engines that ran, e.g. "layout" or "layout>text>vision"
+        self.escalation = ""  # why the cheaper engines' answers were not kept
+        self.vendor = ""
+        self.vendor_unp = ""
+        self.error = ""
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        self.stages[name] = round(self.stages.get(name, 0) + seconds * 1000, 3)
+
+    def record_usage(self, response):
+        usage = getattr(response, "usage_metadata", None)
+        if not usage:
+            return
+        self.prompt_tokens += getattr(usage, "prompt_token_count", 0) or 0
+        self.output_tokens += getattr(usage, "candidates_token_count", 0) or 0
+        self.total_tokens += getattr(usage, "total_token_count", 0) or 0
+        self.cached_tokens += getattr(usage, "cached_content_token_count", 0) or 0
+
+    def record_data(self, data):
+        self.vendor = data.get("Исполнитель_Компания", "")
+        self.vendor_unp = data.get("Исполнитель_УНП", "")
+
+    def to_dict(self):
+        return {
+            "source": self.source,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "vendor": self.vendor,
+            "vendor_unp": self.vendor_unp,
+            "pages": self.pages,
+            "payload_bytes": self.payload_bytes,
+            "pages_skipped": self.pages_skipped,
+            "bytes_saved": self.bytes_saved,
+            "prompt_tokens": self.prompt_tokens,
+            "output_tokens": self.output_tokens,
+            "total_tokens": self.total_tokens,
+            "cached_tokens": self.cached_tokens,
+            "parse_path": self.parse_path,
+            "route": self.route,
+            "escalation": self.escalation,
+            "stages_ms": self.stages,
+            "error": self.error,
+        }
+
+    def finish(self):
+        if self._log:
+            self._log.write(self)
+
+
+# appends document records to a JSONL file and keeps per-vendor totals
+# for the end-of-run summary
+class MetricsLog:
+    def __init__(self, metrics_file=None):
+        self.metrics_file = metrics_file
+        self._lock = threading.Lock()
+        self._vendors = {}
+        self._routes = {}
+        self._skipped = {"docs": 0, "pages": 0, "bytes": 0}
+        if metrics_file and os.path.dirname(metrics_file):
+            os.makedirs(os.path.dirname(metrics_file), exist_ok=True)
+
+    def document(self, source):
+        return DocumentMetrics(source, self)
+
+    def write(self, metrics):
+        record = metrics.to_dict()
+        with self._lock:
+            if self.metrics_file:
+                with open(self.metrics_file, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+            totals = self._vendors.setdefault(metrics.vendor or "?", {
+                "docs": 0, "pages": 0, "payload_bytes": 0, "total_tokens": 0, "errors": 0,
+                "total_ms": 0, "stages_ms": {}, "parse_paths": {}})
+            totals["docs"] += 1
+            totals["pages"] += metrics.pages
+            totals["payload_bytes"] += metrics.payload_bytes
+            totals["total_tokens"] += metrics.total_tokens
+            totals["errors"] += bool(metrics.error)
+            totals["total_ms"] += sum(metrics.stages.values())
+            for name, ms in metrics.stages.items():
+                totals["stages_ms"][name] = totals["stages_ms"].get(name, 0) + ms
+            totals["parse_paths"][metrics.parse_path] = totals["parse_paths"].get(metrics.parse_path, 0) + 1
+            if metrics.route:
+                route = self._routes.setdefault(metrics.route, {"docs": 0, "total_tokens": 0})
+                route["docs"] += 1
+                route["total_tokens"] += metrics.total_tokens
+            if metrics.pages_skipped:
+                self._skipped["docs"] += 1
+                self._skipped["pages"] += metrics.pages_skipped
+                self._skipped["bytes"] += metrics.bytes_saved
+
+    def print_summary(self):
+        with self._lock:
+            vendors = sorted(self._vendors.items(), key=lambda item: -item[1]["docs"])
+            routes = sorted(self._routes.items(), key=lambda item: -item[1]["docs"])
+            skipped = dict(self._skipped)
+        if not vendors:
+            return
+        print(f"\n{'Исполнитель':<40}{'docs':>6}{'pages':>7}{'KB':>9}{'tokens':>10}{'avg ms':>9}{'errors':>8}  parse paths")
+        for vendor, t in vendors:
+            paths = ", ".join(f"{path or '-'}: {count}" for path, count in sorted(t["parse_paths"].items()))
+            print(f"{vendor[:39]:<40}{t['docs']:>6}{t['pages']:>7}{t['payload_bytes'] // 1024:>9}"
+                  f"{t['total_tokens']:>10}{t['total_ms'] / t['docs']:>9.0f}{t['errors']:>8}  {paths}")
+
+        stages = {}
+        docs = 0
+        for _, t in vendors:
+            docs += t["docs"]
+            for name, ms in t["stages_ms"].items():
+                stages[name] = stages.get(name, 0) + ms
+        print("Среднее время этапов, мс: " + ", ".join(f"{name} {ms / docs:.0f}" for name, ms in stages.items()))
+        if routes:
+            print("Маршруты: " + ", ".join(f"{route} {r['docs']} ({r['total_tokens'] // r['docs']} tokens/doc)"
+                                           for route, r in routes))
+        if skipped["pages"]:
+            print(f"Пропущено пустых и повторных страниц: {skipped['pages']} в {skipped['docs']} документах, "
+                  f"~{skipped['bytes'] // 1024} KB")
+        if self.metrics_file:
+            print(f"Metrics written to {self.metrics_file}")
@@ -0,0 +1,139 @@
+import io
+import os
+import shutil
+import tempfile
+from PageSelect import drop_pages, select_pages
+
+MIME_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+
+# how pages are rasterized and encoded before upload
+class RenderProfile:
+    def __init__(self, dpi=72, color="rgb", image_format="png", quality=85, max_dim=0):
+        self.dpi = dpi
+        self.color = color  # rgb, gray or bw (1-bit)
+        self.image_format = image_format  # png, jpeg or webp
+        self.quality = quality
+        self.max_dim = max_dim  # longest side in pixels, 0 - no limit
+
+    @property
+    def mime_type(self):
+        return MIME_TYPES[self.image_format]
+
+
+def encode_page(page, profile):
+    import fitz
+    zoom = profile.dpi / 72
+    if profile.max_dim:
+        zoom = min(zoom, profile.max_dim / max(page.rect.width, page.rect.height))
+    colorspace = fitz.csRGB if profile.color == "rgb" else fitz.csGRAY
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=colorspace, alpha=False)
+
+    # fitz encodes png/jpeg itself, PIL is only needed for 1-bit and webp
+    if profile.color != "bw":
+        if profile.image_format == "png":
+            return pix.tobytes("png")
+        if profile.image_format == "jpeg":
+            return pix.tobytes("jpeg", jpg_quality=profile.quality)
+
+    from PIL import Image
+    img = Image.frombytes("RGB" if profile.color == "rgb" else "L", [pix.width, pix.height], pix.samples)
+    if profile.color == "bw":
+        img = img.convert("1")
+        # jpeg and webp have no 1-bit mode, they get the thresholded image as grayscale
+        if profile.image_format != "png":
+            img = img.convert("L")
+    img_byte_arr = io.BytesIO()
+    if profile.image_format == "png":
+        img.save(img_byte_arr, format="PNG", optimize=True)
+    else:
+        img.save(img_byte_arr, format=profile.image_format.upper(), quality=profile.quality)
+    return img_byte_arr.getvalue()
+
+
+# a rendered page kept in the spool directory instead of memory;
+# len() is its size, like for the bytes of an inline page
+class SpooledPage:
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def read(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+
+def page_bytes(data):
+    return data.read() if isinstance(data, SpooledPage) else data
+
+
+# deletes the spool files of a document once it has been analyzed
+def release_pages(image_data):
+    spool_dirs = set()
+    for data, _ in image_data:
+        if isinstance(data, SpooledPage):
+            spool_dirs.add(os.path.dirname(data.path))
+    for spool_dir in spool_dirs:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+
+
+# runs inside the render process pool, so it opens the document itself;
+# page_numbers may also be a PageSelect spec ("auto", "all", "N");
+# returns [(bytes or SpooledPage, mime_type)] and the size of the same pages
+# as default png when measure_baseline is set (0 otherwise). Pages are
+# rendered one at a time; once memory_cap bytes are held, the rest go to a
+# spool directory under spool_dir. With skip_pages blank and repeated pages are
+# left out before rendering and returned as [(page_num, reason)]
+def render_pages(pdf_file, page_numbers, profile=None, measure_baseline=False, memory_cap=0, spool_dir=None,
+                 skip_pages=False):
+    import fitz
+    profile = profile or RenderProfile()
+    image_data = []
+    baseline_bytes = 0
+    inline_bytes = 0
+    spool = None
+    skipped = []
+    doc = fitz.open(pdf_file)
+    try:
+        if isinstance(page_numbers, str):
+            page_numbers = select_pages(doc, page_numbers)
+        if skip_pages and len(page_numbers) > 1:
+            page_numbers, skipped = drop_pages(doc, page_numbers)
+        for page_num in page_numbers:
+            page = doc.load_page(page_num)
+            data = encode_page(page, profile)
+            if memory_cap and inline_bytes + len(data) > memory_cap:
+                if spool is None:
+                    spool = tempfile.mkdtemp(prefix="pages_", dir=spool_dir)
+                path = os.path.join(spool, f"{page_num:05d}.{profile.image_format}")
+                with open(path, "wb") as f:
+                    f.write(data)
+                data = SpooledPage(path, len(data))
+            else:
+                inline_bytes += len(data)
+            image_data.append((data, profile.mime_type))
+            if measure_baseline:
+                baseline_bytes += len(page.get_pixmap().tobytes("png"))
+    except BaseException:
+        if spool:
+            shutil.rmtree(spool, ignore_errors=True)
+        raise
+    finally:
+        doc.close()
+    return image_data, baseline_bytes, skipped
+
+
+# prints the pages render_pages left out and puts them into the metrics; the bytes
+# saved are estimated from the average size of the pages that were rendered
+def report_skipped(pdf_file, image_data, skipped, metrics=None):
+    if not skipped:
+        return
+    saved = sum(len(data) for data, _ in image_data) // max(1, len(image_data)) * len(skipped)
+    pages = ", ".join(f"{page_num + 1}: {reason}" for page_num, reason in skipped)
+    print(f"{os.path.basename(pdf_file)}: пропущено страниц {len(skipped)} ({pages}), ~{saved // 1024} KB")
+    if metrics:
+        metrics.pages_skipped = len(skipped)
+        metrics.bytes_saved = saved
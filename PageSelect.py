@@ -0,0 +1,163 @@
+import re
+
+# cues of the parts of an invoice the prompt needs; one page per group is enough
+PAGE_CUES = {
+    "header": [r"сч[её]т\s*(-\s*фактура\s*)?№", r"детализация сч[её]та", r"\bакт\b", r"по договору"],
+    "requisites": [r"\bунп\b", r"р/с", r"расч[её]тный сч[её]т", r"\bbic\b", r"\bбик\b", r"\bBY\d{2}\s?[A-Z]{4}",
+                   r"исполнитель", r"заказчик", r"поставщик", r"плательщик"],
+    "total": [r"\bитого\b", r"всего к оплате", r"сумма ндс", r"прописью", r"без ндс"],
+}
+PAGE_CUES = {group: [re.compile(cue, re.IGNORECASE) for cue in cues] for group, cues in PAGE_CUES.items()}
+
+# a page with fewer characters in its text layer is treated as a scan
+MIN_TEXT_CHARS = 50
+
+# gray level below which a pixel counts as ink, and the share of ink pixels
+# below which a scanned page is considered blank
+INK_LEVEL = 200
+BLANK_INK_RATIO = 0.005
+# a page is only left out below this much ink: a sparse invoice may be under
+# BLANK_INK_RATIO, and skipping it is worse than uploading an empty page
+DROP_INK_RATIO = 0.001
+
+# side of the difference hash of a scanned page and how many of its bits may
+# differ; the hash only finds candidates, pages of one form with other figures
+# hash alike too
+HASH_SIZE = 16
+DUPLICATE_BITS = 6
+# share of the ink pixels of a 72 dpi rendering a candidate may differ in and
+# still be the same page; detail pages of one form differ in about a third
+SAME_PAGE_DIFF = 0.02
+INK_BITS = bytes(1 if level < INK_LEVEL else 0 for level in range(256))
+
+
+def page_scores(text):
+    return {group: sum(1 for cue in cues if cue.search(text)) for group, cues in PAGE_CUES.items()}
+
+
+def gray_thumbnail(page, dpi=24):
+    import fitz
+    return page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY, alpha=False)
+
+
+def pixmap_ink(pix):
+    samples = pix.samples
+    dark = samples.translate(None, bytes(range(INK_LEVEL, 256)))
+    return len(dark) / max(1, len(samples))
+
+
+def ink_ratio(page, dpi=24):
+    return pixmap_ink(gray_thumbnail(page, dpi))
+
+
+# difference hash: the thumbnail shrunk to (HASH_SIZE + 1) x HASH_SIZE, one bit
+# per pair of neighbouring pixels in a row
+def page_hash(pix):
+    import fitz
+    thumb = fitz.Pixmap(pix, HASH_SIZE + 1, HASH_SIZE, None)
+    samples = thumb.samples
+    bits = 0
+    for row in range(HASH_SIZE):
+        line = samples[row * thumb.stride:row * thumb.stride + HASH_SIZE + 1]
+        for left, right in zip(line, line[1:]):
+            bits = bits << 1 | (left > right)
+    return bits
+
+
+# one bit per pixel of the page: ink or not
+def ink_map(page, dpi=72):
+    pix = gray_thumbnail(page, dpi)
+    return pix.width, pix.height, int.from_bytes(pix.samples.translate(INK_BITS), "big")
+
+
+def same_page(a, b):
+    if a[:2] != b[:2]:
+        return False
+    differ = bin(a[2] ^ b[2]).count("1")
+    return differ <= SAME_PAGE_DIFF * max(1, bin(a[2] | b[2]).count("1"))
+
+
+# drops blank pages and repeats of a page already kept (blank reverse sides,
+# the same sheet attached again); pages with a text layer are compared by their
+# text, scans by hash and then pixel by pixel, so a rescan of a page is kept
+# rather than risk dropping one with other figures. Returns the kept page
+# numbers and [(page_num, reason)] of the dropped ones; the first page is kept
+# when nothing else is
+def drop_pages(doc, page_numbers):
+    kept = []
+    dropped = []
+    texts = {}
+    scans = []  # (hash, ink ratio, page_num)
+    maps = {}
+    for page_num in page_numbers:
+        page = doc.load_page(page_num)
+        text = " ".join(page.get_text().split())
+        if len(text) >= MIN_TEXT_CHARS:
+            if text in texts:
+                dropped.append((page_num, f"копия стр. {texts[text] + 1}"))
+                continue
+            texts[text] = page_num
+            kept.append(page_num)
+            continue
+
+        pix = gray_thumbnail(page)
+        ink = pixmap_ink(pix)
+        if ink < DROP_INK_RATIO:
+            dropped.append((page_num, "пустая"))
+            continue
+        bits = page_hash(pix)
+
+        def copy_of(n):
+            for m in (n, page_num):
+                if m not in maps:
+                    maps[m] = ink_map(doc.load_page(m))
+            return same_page(maps[n], maps[page_num])
+
+        # sparse pages hash alike, so a copy must also carry about as much ink
+        copy = next((n for other, other_ink, n in scans
+                     if bin(bits ^ other).count("1") <= DUPLICATE_BITS and abs(ink - other_ink) <= 0.2 * other_ink
+                     and copy_of(n)), None)
+        if copy is not None:
+            dropped.append((page_num, f"копия стр. {copy + 1}"))
+            continue
+        scans.append((bits, ink, page_num))
+        kept.append(page_num)
+    if not kept and page_numbers:
+        kept = [page_numbers[0]]
+        dropped = dropped[1:]
+    return kept, dropped
+
+
+# text layer: the best page for each group of cues; scans: first and last non-blank page
+def auto_pages(doc):
+    texts = [page.get_text() for page in doc]
+    if len(texts[0].strip()) >= MIN_TEXT_CHARS:
+        scores = [page_scores(text) for text in texts]
+        selected = set()
+        for group in PAGE_CUES:
+            best = max(range(len(texts)), key=lambda n: (scores[n][group], -n))
+            if scores[best][group]:
+                selected.add(best)
+        return sorted(selected) or [0]
+
+    non_blank = [n for n, page in enumerate(doc) if ink_ratio(page) >= BLANK_INK_RATIO]
+    if not non_blank:
+        return [0]
+    return sorted({non_blank[0], non_blank[-1]})
+
+
+# spec: "auto", "all" or the number of leading pages to keep (0 - all)
+def select_pages(doc, spec="auto"):
+    total_pages = len(doc)
+    if spec == "auto":
+        return auto_pages(doc) if total_pages > 1 else [0]
+    if spec == "all" or int(spec) == 0:
+        return list(range(total_pages))
+    return list(range(min(int(spec), total_pages)))
+
+
+def pages_option(value):
+    if value in ("auto", "all", "ask") or (value.isdigit() and int(value) >= 0):
+        return value
+    import argparse
+    raise argparse.ArgumentTypeError("expected auto, all, ask or a number of pages")
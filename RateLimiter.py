@@ -0,0 +1,32 @@
+import threading
+import time
+from collections import deque
+
+
+# sliding one-minute window limiter for requests and tokens per minute
+class RateLimiter:
+    def __init__(self, rpm=0, tpm=0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._lock = threading.Lock()
+        self._window = deque()  # (timestamp, tokens)
+
+    def acquire(self, tokens=0):
+        if not self.rpm and not self.tpm:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._window and now - self._window[0][0] >= 60:
+                    self._window.popleft()
+
+                used_tokens = sum(t for _, t in self._window)
+                rpm_ok = not self.rpm or len(self._window) < self.rpm
+                # a single oversized request is let through on an empty window
+                tpm_ok = not self.tpm or not self._window or used_tokens + tokens <= self.tpm
+                if rpm_ok and tpm_ok:
+                    self._window.append((now, tokens))
+                    return
+
+                wait = 60 - (now - self._window[0][0])
+            time.sleep(max(wait, 0.05))
@@ -0,0 +1,96 @@
+import hashlib
+import itertools
+import json
+import os
+import tempfile
+import time
+
+
+# several processes may share a cache dir and prune the same entry at once
+def remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+# content-addressed on-disk cache of parsed model responses
+class ResponseCache:
+    def __init__(self, cache_dir=".gemini_cache", max_age_days=30, max_size_mb=256, refresh=False):
+        self.cache_dir = cache_dir
+        self.max_age = max_age_days * 86400
+        self.max_size = max_size_mb * 1024 * 1024
+        self.refresh = refresh
+        os.makedirs(cache_dir, exist_ok=True)
+        self.prune()
+
+    @staticmethod
+    def key(model, prompt, payloads):
+        # payloads may be a generator, so pages on disk are read one at a time
+        h = hashlib.sha256()
+        for part in itertools.chain([model, prompt], payloads):
+            if isinstance(part, str):
+                part = part.encode("utf-8")
+            # length prefix so part boundaries can't collide
+            h.update(len(part).to_bytes(8, "little"))
+            h.update(part)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def get(self, key):
+        if self.refresh:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                value = json.load(f)
+            mtime = os.path.getmtime(path)
+        except (OSError, ValueError):
+            return None
+        if self.max_age and time.time() - mtime > self.max_age:
+            return None
+        # bump atime so size eviction drops least recently used entries first
+        try:
+            os.utime(path, (time.time(), mtime))
+        except OSError:
+            pass  # pruned meanwhile by another process sharing the cache dir
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(value, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def prune(self):
+        entries = []
+        now = time.time()
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if name.endswith(".tmp"):
+                    # leftovers of interrupted writes
+                    if now - st.st_mtime > 3600:
+                        remove(path)
+                    continue
+                if self.max_age and now - st.st_mtime > self.max_age:
+                    remove(path)
+                    continue
+                entries.append((st.st_atime, st.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        if not self.max_size or total <= self.max_size:
+            return
+        for _, size, path in sorted(entries):
+            remove(path)
+            total -= size
+            if total <= self.max_size:
+                break
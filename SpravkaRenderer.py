@@ -0,0 +1,206 @@
+import copy
+import os
+import re
+import sys
+import threading
+
+DEFAULT_TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates", "spravka.xlsx")
+
+PLACEHOLDER = re.compile(r"\{([^{}]+)\}")
+
+
+# the "Бухгалтерская справка" layout; cells hold {placeholders} for the keys of
+# extract_data_from_analysis, {service.*} marks the row repeated per service
+# and {total.*} the sums over services
+def build_default_template(excel_file=DEFAULT_TEMPLATE):
+    import openpyxl
+    from openpyxl.styles import Border, Side, Alignment
+
+    thin_border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = "Sheet1"
+
+    center = Alignment(horizontal='center')
+    right = Alignment(horizontal='right')
+
+    ws["B2"] = "Бухгалтерская справка № Б.Н."
+    ws["D2"] = "от {document_date}"
+    ws["B3"] = "{contract_info}"
+    ws["A5"] = "Исполнитель"
+    ws["B5"] = "{Исполнитель_Компания}"
+    ws["A6"] = "{Исполнитель_УНП}, {Исполнитель_Адрес}"
+    ws["A7"] = "Расчетный счет {Исполнитель_Расчетный_счет}"
+    ws["A8"] = "в {Исполнитель_Банк}"
+    ws["A10"] = "Заказчик"
+    ws["B10"] = "{Заказчик_Компания}, {Заказчик_Адрес}"
+    ws["C12"] = "За период {За период} оказаны услуги"
+
+    #table header
+    ws.merge_cells("B14:E14")
+    ws["B14"] = "Сумма оказанных услуг"
+    ws.merge_cells("A14:A15")
+    ws["A14"] = "Наименование услуги"
+    ws["A14"].alignment = Alignment(horizontal='center', vertical='center')
+    for col_num, header in enumerate(["Сумма без НДС, руб.", "Ставка НДС", "Сумма НДС, руб.", "Сумма с НДС, руб."], start=2):
+        ws.cell(row=15, column=col_num).value = header
+        ws.cell(row=15, column=col_num).alignment = center
+    ws["B14"].alignment = center
+
+    #service row and totals
+    ws["A16"] = "{service.service_name}"
+    ws["A16"].alignment = Alignment(wrap_text=True, vertical='top')
+    ws["A17"] = "Итого"
+    for col_num, key in enumerate(["amount_without_vat", "vat_rate", "vat_amount", "amount_with_vat"], start=2):
+        ws.cell(row=16, column=col_num).value = "{service.%s}" % key
+        ws.cell(row=17, column=col_num).value = "{total.%s}" % key
+        ws.cell(row=16, column=col_num).alignment = right
+        ws.cell(row=17, column=col_num).alignment = right
+    for row in ws["A14:E17"]:
+        for cell in row:
+            cell.border = thin_border
+
+    #footer
+    ws["A19"] = "Стоимость оказанных услуг: {Общая стоимость услуг}"
+    ws["A20"] = "{НДС_Статус}"
+    ws["A22"] = "Документ составлен в единоличном порядке в соответствии с п.1.7. Договора, на основании п. 1 "
+    ws["A23"] = "Постановления Министерства Финансов Республики Беларусь от 12.02.2018 № 13"
+    ws["A25"] = "Основание: {document_number} от {document_date}"
+    ws["A28"] = "{Директор_Должность} {Заказчик_Компания}"
+    ws["E28"] = "{Директор_ФИО}"
+    ws["C28"].border = Border(bottom=Side(style='thin'))
+
+    for col in "ABCDE":
+        ws.column_dimensions[col].width = 16
+    ws.column_dimensions["A"].width = 23
+
+    os.makedirs(os.path.dirname(excel_file) or ".", exist_ok=True)
+    wb.save(excel_file)
+    return excel_file
+
+
+def format_amount(value):
+    return str(value).replace(".", ",")
+
+
+def service_totals(services):
+    total_without_vat = 0
+    total_vat_amount = 0
+    total_with_vat = 0
+    for service in services:
+        try:
+            total_without_vat += float(service.get("amount_without_vat", "0").replace(",", "."))
+        except ValueError: pass
+        try:
+            vat_amount_str = service.get("vat_amount", "0").replace(",", ".")
+            if vat_amount_str != "-":
+                total_vat_amount += float(vat_amount_str)
+        except ValueError: pass
+        try:
+            total_with_vat += float(service.get("amount_with_vat", "0").replace(",", "."))
+        except ValueError: pass
+
+    vat_rate = services[-1].get("vat_rate", "") if services else ""
+    return {
+        "amount_without_vat": format_amount(total_without_vat),
+        "vat_rate": vat_rate if total_without_vat > 0 else "-",
+        "vat_amount": format_amount(total_vat_amount) if total_vat_amount > 0 else "-",
+        "amount_with_vat": format_amount(total_with_vat),
+    }
+
+
+def fill(text, values):
+    return PLACEHOLDER.sub(lambda m: str(values.get(m.group(1), "")), text)
+
+
+# parses the template once into cell specs with shared style objects;
+# render() then only writes values into a fresh workbook
+class SpravkaRenderer:
+    def __init__(self, template=DEFAULT_TEMPLATE):
+        import openpyxl
+        if not os.path.exists(template):
+            build_default_template(template)
+        ws = openpyxl.load_workbook(template).worksheets[0]
+
+        self.title = ws.title
+        self.cells = []  # (row, column, value, style)
+        styles = {}
+        self.service_row = None
+        for row in ws.iter_rows():
+            for cell in row:
+                if cell.value is None and not cell.has_style:
+                    continue
+                # identical styles across cells share one set of objects
+                style_key = cell.style_id
+                if style_key not in styles:
+                    styles[style_key] = (copy.copy(cell.font), copy.copy(cell.border), copy.copy(cell.alignment),
+                                         copy.copy(cell.fill), cell.number_format) if cell.has_style else None
+                value = cell.value
+                if isinstance(value, str) and "{service." in value:
+                    self.service_row = cell.row
+                self.cells.append((cell.row, cell.column, value, styles[style_key]))
+
+        self.merges = [(m.min_row, m.min_col, m.max_row, m.max_col) for m in ws.merged_cells.ranges]
+        self.widths = {key: dim.width for key, dim in ws.column_dimensions.items() if dim.width}
+        self.heights = {key: dim.height for key, dim in ws.row_dimensions.items() if dim.height}
+        self.style_count = len(styles)
+
+    def _shift(self, row, extra_rows):
+        return row + extra_rows if self.service_row and row > self.service_row else row
+
+    def render(self, data, excel_file):
+        import openpyxl
+        services = data.get("services", [])
+        values = {key: value for key, value in data.items() if isinstance(value, str)}
+        values.update({"total." + key: value for key, value in service_totals(services).items()})
+        extra_rows = len(services) - 1
+
+        wb = openpyxl.Workbook()
+        ws = wb.active
+        ws.title = self.title
+
+        for row, column, value, style in self.cells:
+            if row == self.service_row:
+                targets = [(row + i, {**values, **{"service." + k: v for k, v in service.items()}})
+                           for i, service in enumerate(services)]
+            else:
+                targets = [(self._shift(row, extra_rows), values)]
+            for target_row, target_values in targets:
+                cell = ws.cell(row=target_row, column=column)
+                cell.value = fill(value, target_values) if isinstance(value, str) else value
+                if style:
+                    cell.font, cell.border, cell.alignment, cell.fill, cell.number_format = style
+
+        for min_row, min_col, max_row, max_col in self.merges:
+            ws.merge_cells(start_row=self._shift(min_row, extra_rows), start_column=min_col,
+                           end_row=self._shift(max_row, extra_rows), end_column=max_col)
+        for key, width in self.widths.items():
+            ws.column_dimensions[key].width = width
+        for key, height in self.heights.items():
+            ws.row_dimensions[self._shift(key, extra_rows)].height = height
+
+        if os.path.exists(excel_file):
+            os.remove(excel_file)
+        wb.save(excel_file)
+        print(f"Data written to {excel_file}")
+
+
+_renderers = {}
+_renderers_lock = threading.Lock()
+
+
+def get_renderer(template=None):
+    template = template or DEFAULT_TEMPLATE
+    with _renderers_lock:
+        if template not in _renderers:
+            _renderers[template] = SpravkaRenderer(template)
+        return _renderers[template]
+
+
+def write_data_to_excel(data, excel_file="output.xlsx", template=None):
+    get_renderer(template).render(data, excel_file)
+
+
+if __name__ == "__main__":
+    # regenerate the default template: python SpravkaRenderer.py [path]
+    print(f"Template written to {build_default_template(*sys.argv[1:2])}")
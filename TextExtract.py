@@ -0,0 +1,64 @@
+import io
+
+# horizontal gap (in points) between words that starts a new table cell
+CELL_GAP = 12
+
+_markitdown = None
+
+
+# rebuild page lines from word boxes, separating table columns with " | "
+def page_text(page):
+    rows = []
+    for x0, y0, x1, y1, word, *_ in page.get_text("words", sort=True):
+        mid = (y0 + y1) / 2
+        # words whose vertical centre falls inside the previous row's band belong to it
+        if rows and rows[-1]["top"] <= mid <= rows[-1]["bottom"]:
+            rows[-1]["words"].append((x0, x1, word))
+        else:
+            rows.append({"top": y0, "bottom": y1, "words": [(x0, x1, word)]})
+
+    lines = []
+    for row in rows:
+        line = ""
+        prev_x1 = None
+        for x0, x1, word in sorted(row["words"]):
+            if prev_x1 is None:
+                line = word
+            elif x0 - prev_x1 > CELL_GAP:
+                line += " | " + word
+            else:
+                line += " " + word
+            prev_x1 = x1
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def fitz_text(doc, page_numbers):
+    return "\n\n".join(page_text(doc.load_page(n)) for n in page_numbers)
+
+
+def get_markitdown():
+    global _markitdown
+    if _markitdown is None:
+        from markitdown import MarkItDown  # type: ignore
+        _markitdown = MarkItDown()
+    return _markitdown
+
+
+# optional backend: MarkItDown on an in-memory subset of the document
+def markitdown_text(doc, page_numbers):
+    import fitz
+
+    subset = fitz.open()
+    for page_num in page_numbers:
+        subset.insert_pdf(doc, from_page=page_num, to_page=page_num)
+    pdf_bytes = subset.tobytes()
+    subset.close()
+    return get_markitdown().convert_stream(io.BytesIO(pdf_bytes), file_extension=".pdf").text_content
+
+
+BACKENDS = {"fitz": fitz_text, "markitdown": markitdown_text}
+
+
+def extract_text(doc, page_numbers, backend="fitz"):
+    return BACKENDS[backend](doc, page_numbers)
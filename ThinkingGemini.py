@@ -1,25 +1,32 @@
-from google import genai
-import openpyxl
-from openpyxl.styles import Border, Side, Alignment
 import re
 import argparse
 import os
-import json
-import fitz
-import io
-from PIL import Image
-import time  # Import the time module
+import time
+from collections import deque
+from RateLimiter import RateLimiter
+from ResponseCache import ResponseCache
+from PageRender import RenderProfile, SpooledPage, page_bytes, release_pages, render_pages, report_skipped
+from PageSelect import pages_option
+from TextExtract import BACKENDS
+from InvoiceRegister import InvoiceRegister
+from SpravkaRenderer import write_data_to_excel
+from Metrics import MetricsLog, timed
+from BatchJournal import BatchJournal
+from InputDiscovery import date_option, find_pdfs
+from BulkExport import BulkExport, formats_option
+from ApiRetry import AimdController, RetryingClient
+from ContextCache import ContextCache
+from InvoiceSchema import Invoice, PACK_SCHEMA, generation_config, load_json, merge_invoices, request_invoice, validate
 
 # init model
 model = 'gemini-2.0-flash-thinking-exp-01-21'
 
-# init border style
-thin_border = Border(left=Side(style='thin'), right=Side(style='thin'),
-                     top=Side(style='thin'), bottom=Side(style='thin'))
+# rough token cost of one page image for the tpm limiter
+IMAGE_TOKENS = 258
 
 
-def analyze_invoice(invoice_image_data, client):
-    prompt = """
+# init prompt
+PROMPT = """
     Ты - опытный бухгалтер, специализирующийся на анализе счетов на оказание услуг.
     Твоя задача - извлечь из предоставленного текста счета, распознанного из изображения, ключевую информацию и
     представить её в структурированном JSON формате.
@@ -97,27 +104,185 @@ def analyze_invoice(invoice_image_data, client):
         ```
     Текст счета:"""
 
-    # Construct the content with the prompt as text and images
-    content = [prompt]
-    for image_data in invoice_image_data:
-        image = Image.open(io.BytesIO(image_data))
-        content.append(image)
+
+# the part of the prompt that is the same for every invoice
+PROMPT_PREFIX = PROMPT.rsplit("Текст счета:", 1)[0]
+
+# appended instead of "Текст счета:" when several invoices share one request
+PACK_PROMPT = PROMPT_PREFIX + """
+    3.  **Несколько счетов в одном запросе:** Ниже приведены несколько отдельных счетов. Каждый начинается
+        со строки "Документ <id>:", за которой идут изображения его страниц. Проанализируй каждый счет
+        независимо от остальных и верни JSON-массив: по одному объекту описанной выше структуры на каждый
+        счет, с дополнительным полем "document_id" (значение <id> из строки "Документ <id>:").
+    """
+
+# appended instead of "Текст счета:" when a document is analyzed in chunks of pages
+CHUNK_PROMPT = PROMPT_PREFIX + """
+    3.  **Часть документа:** Ниже приведены не все страницы документа. Если среди них нет итоговой строки
+        "ИТОГО", верни "service_details" пустым списком, не подставляй вместо нее строки детализации.
+    Текст счета:"""
+
+
+# the encoded page images go to the request as is; spooled pages are read
+# back, or uploaded through the files API when uploads is a list to record them in
+def page_parts(invoice_image_data, client, uploads=None):
+    from google.genai import types
+    parts = []
+    for data, mime_type in invoice_image_data:
+        if isinstance(data, SpooledPage) and uploads is not None:
+            uploaded = client.files.upload(file=data.path, config=types.UploadFileConfig(mime_type=mime_type))
+            uploads.append(uploaded)
+            parts.append(types.Part.from_uri(file_uri=uploaded.uri, mime_type=mime_type))
+        else:
+            parts.append(types.Part.from_bytes(data=page_bytes(data), mime_type=mime_type))
+    return parts
+
+
+# what the response cache key is built from; spooled pages are read one at a time
+def cache_parts(invoice_image_data):
+    for data, mime_type in invoice_image_data:
+        yield page_bytes(data)
+        yield mime_type
+
+
+# consecutive pages, each chunk at most memory_cap bytes (and at least one page)
+def page_chunks(invoice_image_data, memory_cap):
+    chunk, size = [], 0
+    for page in invoice_image_data:
+        if chunk and size + len(page[0]) > memory_cap:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(page)
+        size += len(page[0])
+    if chunk:
+        yield chunk
+
+
+# memory_cap: documents whose pages don't fit are uploaded page by page through
+# the files API (upload_pages) or analyzed in chunks whose answers are merged
+def analyze_invoice(invoice_image_data, client, limiter=None, cache=None, metrics=None, context=None,
+                    memory_cap=0, upload_pages=False):
+    prompt = PROMPT
+
+    cache_key = None
+    if cache:
+        cache_key = cache.key(model, prompt, cache_parts(invoice_image_data))
+        cached = cache.get(cache_key)
+        if cached is not None:
+            if metrics:
+                metrics.parse_path = "cache"
+            return cached
+
+    oversized = memory_cap and sum(len(data) for data, _ in invoice_image_data) > memory_cap
+    parse_path = "failed"
+    uploads = []
+    try:
+        if oversized and not upload_pages:
+            partials = []
+            for chunk in page_chunks(invoice_image_data, memory_cap):
+                partial, parse_path = request_invoice(client, model, CHUNK_PROMPT, page_parts(chunk, client), metrics,
+                                                      limiter, len(CHUNK_PROMPT) // 4 + IMAGE_TOKENS * len(chunk),
+                                                      context=context, partial=True)
+                partials.append(Invoice.from_dict(partial))
+            invoice = merge_invoices(partials)
+            errors = validate(invoice)
+            if errors:
+                print(f"Warning: invalid fields after merging {len(partials)} chunks: {', '.join(errors)}")
+            result, parse_path = invoice.to_dict(), "invalid" if errors else "chunks"
+        else:
+            pages = page_parts(invoice_image_data, client, uploads if oversized else None)
+            result, parse_path = request_invoice(client, model, prompt, pages, metrics, limiter,
+                                                 len(prompt) // 4 + IMAGE_TOKENS * len(invoice_image_data),
+                                                 context=context)
+    except Exception as e:
+        if metrics:
+            metrics.parse_path = parse_path
+            metrics.error = str(e)
+        return f"Error: {e}"
+    finally:
+        for uploaded in uploads:
+            try:
+                client.files.delete(name=uploaded.name)
+            except Exception:
+                pass  # uploaded files expire by themselves
+
+    if metrics:
+        metrics.parse_path = parse_path
+
+    if cache_key:
+        cache.put(cache_key, result)
+    return result
+
+
+# several invoices in one request; returns {index: result} for the invoices
+# answered with a usable object, the caller retries the others one by one
+def analyze_invoice_pack(invoices, client, limiter=None, cache=None, metrics=None):
+    metrics = metrics or [None] * len(invoices)
+    results = {}
+    cache_keys = {}
+    for i, invoice_image_data in enumerate(invoices):
+        if cache:
+            cache_keys[i] = cache.key(model, PROMPT, cache_parts(invoice_image_data))
+            cached = cache.get(cache_keys[i])
+            if cached is not None:
+                results[i] = cached
+                if metrics[i]:
+                    metrics[i].parse_path = "cache"
+    pending = [i for i in range(len(invoices)) if i not in results]
+    if len(pending) < 2:
+        return results
+
+    from google.genai import types
+
+    content = [PACK_PROMPT]
+    for i in pending:
+        content.append(f"Документ doc{i + 1}:")
+        for image_data, mime_type in invoices[i]:
+            content.append(types.Part.from_bytes(data=image_data, mime_type=mime_type))
     try:
+        if limiter:
+            limiter.acquire(len(PACK_PROMPT) // 4 + sum(IMAGE_TOKENS * len(invoices[i]) for i in pending))
+        start = time.perf_counter()
         response = client.models.generate_content(
             model=model,
-            contents=content
+            contents=content,
+            config=generation_config(model, PACK_SCHEMA)
         )
-        json_text = response.text
-        try:
-            return json.loads(json_text)
-        except json.JSONDecodeError:
-            json_text = re.sub(r'```json\n?|```', '', json_text).strip()
-            try:
-                return json.loads(json_text)
-            except:
-                return json.loads(json_text.replace("'", '"'))
+        elapsed = time.perf_counter() - start
+        answer = load_json(response.text)
     except Exception as e:
-        return f"Error: {e}"
+        print(f"Error in packed request: {e}")
+        return results
+
+    # the model may wrap the array into an object
+    if isinstance(answer, dict):
+        answer = next((value for value in answer.values() if isinstance(value, list)), [answer])
+    for item in answer if isinstance(answer, list) else []:
+        if not isinstance(item, dict):
+            continue
+        match = re.fullmatch(r"doc(\d+)", str(item.get("document_id", "")).strip())
+        i = int(match.group(1)) - 1 if match else -1
+        invoice = Invoice.from_dict(item)
+        # invalid documents are retried alone, where they get the targeted re-ask
+        if i not in pending or i in results or validate(invoice):
+            continue
+        results[i] = invoice.to_dict()
+        if cache:
+            cache.put(cache_keys[i], results[i])
+
+    # the shared call's time and tokens are split by page count
+    pages = sum(len(invoices[i]) for i in pending)
+    usage = getattr(response, "usage_metadata", None)
+    for i in pending:
+        if metrics[i] and i in results:
+            share = len(invoices[i]) / pages
+            metrics[i].parse_path = "pack"
+            metrics[i].add_time("api", elapsed * share)
+            if usage:
+                metrics[i].prompt_tokens += int((usage.prompt_token_count or 0) * share)
+                metrics[i].output_tokens += int((usage.candidates_token_count or 0) * share)
+                metrics[i].total_tokens += int((usage.total_token_count or 0) * share)
+    return results
 
 
 def extract_data_from_analysis(analysis_result):
@@ -156,142 +321,73 @@ def extract_data_from_analysis(analysis_result):
     return data
 
 
-def write_data_to_excel(data, excel_file="output.xlsx"):
-    if os.path.exists(excel_file):
-        os.remove(excel_file)
-
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = "Sheet1"
-
-    # write data
-    ws.cell(row=2, column=2).value = "Бухгалтерская справка № Б.Н."
-    ws.cell(row=2, column=4).value = "от " + data.get("document_date", "")
-    ws.cell(row=3, column=2).value = data.get("contract_info", "")
-    ws.cell(row=5, column=1).value = "Исполнитель"
-    ws.cell(row=5, column=2).value = data.get("Исполнитель_Компания", "")
-    executor_details = f'{data.get("Исполнитель_УНП", "")}, {data.get("Исполнитель_Адрес", "")}'
-    ws.cell(row=6, column=1).value = executor_details
-    ws.cell(row=7, column=1).value = 'Расчетный счет ' + data.get(
-        "Исполнитель_Расчетный_счет", "")
-    ws.cell(row=8, column=1).value = "в " + data.get("Исполнитель_Банк", "")
-    ws.cell(row=10, column=1).value = "Заказчик"
-    client_details = f'{data.get("Заказчик_Компания", "")}, {data.get("Заказчик_Адрес", "")}'
-    ws.cell(row=10, column=2).value = client_details
-    ws.cell(row=12, column=3).value = "За период " + data.get(
-        "За период", "") + " оказаны услуги"
-
-    # Table Data
-    table_start_row = 15
-    ws.merge_cells(start_row=table_start_row - 1,
-                   start_column=2,
-                   end_row=table_start_row - 1,
-                   end_column=5)
-    ws.cell(row=table_start_row - 1, column=2).value = "Сумма оказанных услуг"
-    ws.cell(row=table_start_row - 1,
-            column=2).alignment = Alignment(horizontal='center')
-    ws.cell(row=table_start_row - 1, column=2).border = thin_border
-    ws.merge_cells(start_row=table_start_row - 1,
-                   start_column=1,
-                   end_row=table_start_row,
-                   end_column=1)
-    ws.cell(row=table_start_row - 1,
-            column=1).value = "Наименование услуги"
-    ws.cell(row=table_start_row - 1,
-            column=1).alignment = Alignment(horizontal='center',
-                                              vertical='center')
-    ws.cell(row=table_start_row - 1, column=1).border = thin_border
-
-    # write table headers
-    table_header = ["Сумма без НДС, руб.", "Ставка НДС", "Сумма НДС, руб.", "Сумма с НДС, руб."]
-    for col_num, header in enumerate(table_header, start=2):
-        cell = ws.cell(row=table_start_row, column=col_num)
-        cell.value = header
-        cell.border = thin_border
-        cell.alignment = Alignment(horizontal='center')
-
-    row_num = table_start_row + 1
-    total_without_vat = 0
-    total_vat_amount = 0
-    total_with_vat = 0
-
-    # write table data
-    for service in data.get("services", []):
-        service_name_cell = ws.cell(row=row_num, column=1)
-        service_name_cell.value = service.get("service_name", "")
-        service_name_cell.alignment = Alignment(wrap_text=True,
-                                                  vertical='top')
-        ws.cell(row=row_num, column=2).value = service.get(
-            "amount_without_vat", "")
-        ws.cell(row=row_num, column=3).value = service.get("vat_rate", "")
-        ws.cell(row=row_num, column=4).value = service.get("vat_amount", "")
-        ws.cell(row=row_num, column=5).value = service.get(
-            "amount_with_vat", "")
-
-        # calculate totals
-        try:
-            total_without_vat += float(
-                service.get("amount_without_vat", "0").replace(",", "."))
-        except ValueError:
-            pass
-        try:
-            vat_amount_str = service.get("vat_amount", "0").replace(",", ".")
-            if vat_amount_str != "-":
-                total_vat_amount += float(vat_amount_str)
-        except ValueError:
-            pass
-        try:
-            total_with_vat += float(
-                service.get("amount_with_vat", "0").replace(",", "."))
-        except ValueError:
-            pass
-        row_num += 1
-
-    ws.cell(row=row_num, column=1).value = "Итого"
-    ws.cell(row=row_num, column=2).value = str(total_without_vat).replace(
-        ".", ",")
-    ws.cell(row=row_num, column=3).value = service.get(
-        "vat_rate", "") if total_without_vat > 0 else "-"
-    ws.cell(row=row_num, column=4).value = str(total_vat_amount).replace(
-        ".", ",") if total_vat_amount > 0 else "-"
-    ws.cell(row=row_num, column=5).value = str(total_with_vat).replace(".",
-                                                                          ",")
-
-    for row in ws[table_start_row - 1:row_num]:
-        for cell in row:
-            cell.border = thin_border
-            if cell.row > table_start_row and cell.column > 1:
-                cell.alignment = Alignment(horizontal='right')
-
-    # Shifting data after the table
-    data_start_row = row_num + 2
-
-    ws.cell(row=data_start_row,
-            column=1).value = "Стоимость оказанных услуг: " + data.get(
-                "Общая стоимость услуг", "")
-    ws.cell(row=data_start_row + 1, column=1).value = data.get("НДС_Статус",
-                                                                 "")
-    ws.cell(row=data_start_row + 3,
-            column=1).value = "Документ составлен в единоличном порядке в соответствии с п.1.7. Договора, на основании п. 1 "
-    ws.cell(row=data_start_row + 4,
-            column=1).value = "Постановления Министерства Финансов Республики Беларусь от 12.02.2018 № 13"
-    ws.cell(row=data_start_row + 6,
-            column=1).value = "Основание: " + data.get(
-                "document_number", "") + " от " + data.get("document_date", "")
-    ws.cell(row=data_start_row + 9,
-            column=1).value = f"{data.get('Директор_Должность', '')} {data.get('Заказчик_Компания', '')}"
-    ws.cell(row=data_start_row + 9, column=5).value = data.get(
-        "Директор_ФИО", "")
-    ws.cell(row=data_start_row + 9, column=3).border = Border(
-        bottom=Side(style='thin'))
-
-    # set column widths
-    column_widths = {'A': 22, 'B': 15, 'C': 15, 'D': 15, 'E': 15}
-    for col, width in column_widths.items():
-        ws.column_dimensions[col].width = width + 1
-
-    wb.save(excel_file)
-    print(f"Data written to {excel_file}")
+def process_invoice(pdf_file, image_data, client, limiter, cache, output_file, register=None, template=None, metrics=None,
+                    journal=None, context=None, memory_cap=0, upload_pages=False, export=None):
+    try:
+        analysis_result = analyze_invoice(image_data, client, limiter, cache, metrics, context, memory_cap, upload_pages)
+    finally:
+        release_pages(image_data)
+    #print("\nРезультат анализа:")
+    #print(analysis_result)
+    finish_invoice(pdf_file, analysis_result, output_file, register, template, metrics, journal, export)
+
+
+def process_pack(pack, client, limiter, cache, register=None, template=None, journal=None, context=None, export=None):
+    results = analyze_invoice_pack([image_data for _, image_data, _, _ in pack], client, limiter, cache,
+                                   [metrics for *_, metrics in pack])
+    for i, (pdf_file, image_data, output_file, metrics) in enumerate(pack):
+        if i in results:
+            finish_invoice(pdf_file, results[i], output_file, register, template, metrics, journal, export)
+        else:
+            # missing or broken in the packed answer
+            if len(pack) > 1:
+                print(f"Повторный запрос для '{pdf_file}' отдельно.")
+            process_invoice(pdf_file, image_data, client, limiter, cache, output_file, register, template, metrics, journal,
+                            context, export=export)
+
+
+def finish_invoice(pdf_file, analysis_result, output_file, register=None, template=None, metrics=None, journal=None,
+                   export=None):
+    if isinstance(analysis_result, str):
+        # a failed request must not turn into an empty справка
+        print(f"Error in analysis of '{pdf_file}': {analysis_result}")
+        if journal:
+            journal.update(pdf_file, "failed", error=analysis_result)
+        if metrics:
+            metrics.finish()
+        return {}
+    if journal:
+        journal.update(pdf_file, "analyzed", result=analysis_result)
+    with timed(metrics, "extract"):
+        extracted_data = extract_data_from_analysis(analysis_result)
+    with timed(metrics, "write"):
+        if register:
+            register.add(os.path.basename(pdf_file), extracted_data)
+        if export:
+            export.add(pdf_file, extracted_data)
+        if output_file:
+            write_data_to_excel(extracted_data, output_file, template)
+    if journal:
+        journal.update(pdf_file, "done", data=extracted_data)
+    if metrics:
+        metrics.record_data(extracted_data)
+        metrics.finish()
+    return extracted_data
+
+
+def process_document(pdf_file, engine, output_file, register=None, template=None, metrics=None, journal=None,
+                     pages=None, export=None):
+    analysis_result = engine.analyze(pdf_file, metrics, pages)
+    if metrics and not metrics.route:
+        metrics.route = engine.name
+    finish_invoice(pdf_file, analysis_result, output_file, register, template, metrics, journal, export)
+
+
+# render in the pool process and report how long it took there
+def render_timed(*args):
+    start = time.perf_counter()
+    result = render_pages(*args)
+    return result, time.perf_counter() - start
 
 
 def main():
@@ -304,96 +400,333 @@ def main():
                         help="Path to the input PDF file or directory containing PDF files.")
     parser.add_argument("-k", "--key", required=True,
                         help="Your Google Gemini API key.")
+    parser.add_argument("-p", "--pages", type=pages_option, default="auto",
+                        help="Pages sent to the model: auto (header, requisites and ИТОГО pages), all, "
+                             "N leading pages or ask (prompt for every file).")
+    parser.add_argument("--include", action="append", default=None,
+                        help="Glob of files to process, repeatable (default: *.pdf). "
+                             "Patterns with '/' match the path relative to the input directory.")
+    parser.add_argument("--exclude", action="append", default=[],
+                        help="Glob of files or directories to skip, repeatable.")
+    parser.add_argument("--no-recursive", action="store_true",
+                        help="Don't descend into subdirectories of the input directory.")
+    parser.add_argument("--min-size", type=int, default=0,
+                        help="Skip files smaller than this many KB.")
+    parser.add_argument("--max-size", type=int, default=0,
+                        help="Skip files larger than this many KB (0 - no limit).")
+    parser.add_argument("--modified-after", type=date_option, default=None,
+                        help="Only files modified on or after this date (YYYY-MM-DD).")
+    parser.add_argument("--modified-before", type=date_option, default=None,
+                        help="Only files modified before this date (YYYY-MM-DD).")
+    parser.add_argument("--engine", choices=["vision", "text", "layout", "cascade"], default="vision",
+                        help="vision - page images to the thinking model, text - extracted text to the fast model, "
+                             "layout - learned vendor layouts without a model call, "
+                             "cascade - layout, then text, then vision, each only when the previous answer fails validation.")
+    parser.add_argument("--templates-dir", default=".layout_templates",
+                        help="Where the cascade keeps the learned layouts of recurring vendors.")
+    parser.add_argument("--no-templates", action="store_true",
+                        help="Don't read or learn vendor layouts in the cascade.")
+    parser.add_argument("--extractor", choices=sorted(BACKENDS), default="fitz",
+                        help="Text extraction backend of the text engine.")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Number of Gemini requests processed concurrently.")
+    parser.add_argument("--rpm", type=int, default=6,
+                        help="Max requests per minute (0 - no limit).")
+    parser.add_argument("--tpm", type=int, default=0,
+                        help="Max tokens per minute (0 - no limit).")
+    parser.add_argument("--max-retries", type=int, default=5,
+                        help="Retries of a request after 429/5xx and network errors.")
+    parser.add_argument("--pack-tokens", type=int, default=0,
+                        help="Pack several invoices into one request up to this many tokens (0 - one invoice per request).")
+    parser.add_argument("--pack-max", type=int, default=8,
+                        help="Max invoices in one packed request.")
+    parser.add_argument("--render-workers", type=int, default=None,
+                        help="Number of processes rendering pages (default: CPU count).")
+    parser.add_argument("--prefetch", type=int, default=4,
+                        help="Max number of files rendered ahead of the Gemini requests.")
+    parser.add_argument("--memory-cap", type=int, default=64,
+                        help="MB of page images one document may hold in memory; the rest is spooled to disk "
+                             "and the document is analyzed in chunks or uploaded (0 - no limit).")
+    parser.add_argument("--spool-dir", default=None,
+                        help="Directory for spooled page images (default: system temp).")
+    parser.add_argument("--upload-pages", action="store_true",
+                        help="Send documents over the memory cap in one request through the Gemini files API instead of in chunks.")
+    parser.add_argument("--keep-all-pages", action="store_true",
+                        help="Upload blank and repeated pages too (by default they are left out before rendering).")
+    parser.add_argument("--dpi", type=int, default=72,
+                        help="Page render resolution.")
+    parser.add_argument("--color", choices=["rgb", "gray", "bw"], default="rgb",
+                        help="Page image color mode (bw - 1-bit).")
+    parser.add_argument("--format", choices=["png", "jpeg", "webp"], default="png",
+                        help="Page image encoding.")
+    parser.add_argument("--quality", type=int, default=85,
+                        help="JPEG/WebP quality.")
+    parser.add_argument("--max-dim", type=int, default=0,
+                        help="Max page image side in pixels (0 - no limit).")
+    parser.add_argument("--payload-stats", action="store_true",
+                        help="Also measure default PNG size per page to compare against the render profile.")
+    parser.add_argument("--output", choices=["spravka", "register", "both"], default="spravka",
+                        help="spravka - a workbook per invoice, register - one workbook for the whole batch.")
+    parser.add_argument("--register", default=None,
+                        help="Path of the register workbook (default: invoice_register.xlsx next to the input).")
+    parser.add_argument("--template", default=None,
+                        help="Template workbook of the справка (default: templates/spravka.xlsx).")
+    parser.add_argument("--export", default=None,
+                        help="Directory to append invoices and service lines to as flat files for analytics.")
+    parser.add_argument("--export-format", type=formats_option, default=["jsonl", "csv"],
+                        help="Comma-separated export formats: jsonl, csv, parquet (needs pyarrow).")
+    parser.add_argument("--export-batch", type=int, default=200,
+                        help="Invoices buffered before the export files are written.")
+    parser.add_argument("--metrics", default=None,
+                        help="Append per-document timings, payload size and token usage to this JSONL file.")
+    parser.add_argument("--journal", default=None,
+                        help="Journal of the batch run; finished files are skipped on the next run "
+                             "(default: .invoice_journal.sqlite next to the input).")
+    parser.add_argument("--no-journal", action="store_true",
+                        help="Process every file and don't keep a journal.")
+    parser.add_argument("--no-context-cache", action="store_true",
+                        help="Send the full instruction block with every request instead of caching it on the Gemini side.")
+    parser.add_argument("--context-ttl", type=int, default=3600,
+                        help="Lifetime of the cached instruction block in seconds; it is extended while the run goes on.")
+    parser.add_argument("--cache-dir", default=".gemini_cache",
+                        help="Directory of the model response cache.")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Don't read or write cached model responses.")
+    parser.add_argument("--refresh", action="store_true",
+                        help="Ignore cached responses and overwrite them with fresh ones.")
 
     args = parser.parse_args()
 
-    client = genai.Client(api_key=args.key)
+    # heavy dependencies are imported only after the arguments are parsed
+    import fitz
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+    from google import genai
+
+    workers = max(1, args.workers)
+    limiter = RateLimiter(rpm=args.rpm, tpm=args.tpm)
+    # requests in flight start at --workers and shrink on 429s
+    client = RetryingClient(genai.Client(api_key=args.key), AimdController(workers), limiter, args.max_retries)
+    context = None
+    if args.engine == "vision" and not args.no_context_cache:
+        context = ContextCache(client, model, PROMPT_PREFIX, args.context_ttl)
+    memory_cap = args.memory_cap * 1024 * 1024
+    cache = None if args.no_cache else ResponseCache(args.cache_dir, refresh=args.refresh)
+    profile = RenderProfile(dpi=args.dpi, color=args.color, image_format=args.format,
+                            quality=args.quality, max_dim=args.max_dim)
 
     input_path = args.input
 
     if os.path.isfile(input_path):
         pdf_files = [input_path]
     elif os.path.isdir(input_path):
-        pdf_files = [
-            os.path.join(input_path, f)
-            for f in os.listdir(input_path)
-            if f.lower().endswith('.pdf')
-        ]
-        if not pdf_files:
-            print(f"Error: No PDF files found in directory '{input_path}'.")
-            return
+        # a generator: files are picked up while the tree is still being walked
+        pdf_files = find_pdfs(input_path, args.include or ["*.pdf"], args.exclude, not args.no_recursive,
+                              args.min_size * 1024, args.max_size * 1024, args.modified_after, args.modified_before)
     else:
         print(f"Error: Input path '{input_path}' is not a valid file or directory.")
         return
 
+    metrics_log = MetricsLog(args.metrics) if args.metrics else None
+
+    register = None
+    if args.output != "spravka":
+        register_file = args.register or os.path.join(
+            input_path if os.path.isdir(input_path) else os.path.dirname(input_path), "invoice_register.xlsx")
+        register = InvoiceRegister(register_file)
+
+    journal = None
+    if not args.no_journal:
+        journal = BatchJournal(args.journal or os.path.join(
+            input_path if os.path.isdir(input_path) else os.path.dirname(input_path), ".invoice_journal.sqlite"))
+
+    export = None
+    if args.export:
+        export = BulkExport(args.export, args.export_format, args.export_batch,
+                            on_flush=journal.mark_exported if journal else None)
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    render_pool = ProcessPoolExecutor(max_workers=args.render_workers)
+    # text and cascade runs go document by document through the engine registry;
+    # vision keeps the render-ahead pipeline with packing below
+    engine = None
+    if args.engine != "vision":
+        from Engines import build_engine
+        engine = build_engine(args.engine, client, limiter, cache, args, render_pool)
+    rendering = deque()  # (pdf_file, output_file, future) in submission order
+    in_flight = {}
+    pack = []  # (pdf_file, image_data, output_file, metrics) waiting for a packed request
+    pack_tokens = 0
+
+    def collect(done):
+        for future in done:
+            pdf_file = in_flight.pop(future)
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error processing '{pdf_file}': {e}")
+
+    def submit(label, func, *func_args):
+        # keep at most two jobs per worker queued so rendered pages don't pile up
+        if len(in_flight) >= workers * 2:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            collect(done)
+        future = executor.submit(func, *func_args)
+        in_flight[future] = label
+
+    def flush_pack():
+        nonlocal pack, pack_tokens
+        if pack:
+            submit(", ".join(item[0] for item in pack), process_pack, pack, client, limiter, cache, register, args.template,
+                   journal, context, export)
+        pack = []
+        pack_tokens = 0
+
+    def hand_off():
+        nonlocal pack_tokens
+        pdf_file, output_file, render_future = rendering.popleft()
+        try:
+            (image_data, baseline_bytes, skipped), render_seconds = render_future.result()
+        except Exception as e:
+            print(f"Error rendering '{pdf_file}': {e}")
+            if journal:
+                journal.update(pdf_file, "failed", error=str(e))
+            return
+        if journal:
+            journal.update(pdf_file, "rendered")
+
+        page_bytes = sum(len(data) for data, _ in image_data) // max(1, len(image_data))
+        if baseline_bytes:
+            print(f"{os.path.basename(pdf_file)}: {len(image_data)} pages, {baseline_bytes // max(1, len(image_data))} -> {page_bytes} bytes/page")
+        else:
+            print(f"{os.path.basename(pdf_file)}: {len(image_data)} pages, {page_bytes} bytes/page")
+
+        doc_metrics = None
+        if metrics_log:
+            doc_metrics = metrics_log.document(pdf_file)
+            doc_metrics.add_time("render", render_seconds)
+            doc_metrics.pages = len(image_data)
+            doc_metrics.payload_bytes = sum(len(data) for data, _ in image_data)
+        report_skipped(pdf_file, image_data, skipped, doc_metrics)
+
+        # documents with spooled pages are never packed
+        if not args.pack_tokens or any(isinstance(data, SpooledPage) for data, _ in image_data):
+            submit(pdf_file, process_invoice, pdf_file, image_data, client, limiter, cache, output_file, register, args.template,
+                   doc_metrics, journal, context, memory_cap, args.upload_pages, export)
+            return
+
+        # pack size follows the token budget: small invoices share a request, big ones go alone
+        tokens = IMAGE_TOKENS * len(image_data)
+        if pack and (len(PACK_PROMPT) // 4 + pack_tokens + tokens > args.pack_tokens or len(pack) >= args.pack_max):
+            flush_pack()
+        pack.append((pdf_file, image_data, output_file, doc_metrics))
+        pack_tokens += tokens
+
+    found = 0
     for pdf_file in pdf_files:
+        found += 1
         if not os.path.exists(pdf_file):
             print(f"Error: Input file '{pdf_file}' not found.")
             continue  # Skip to the next file if current one not found
 
         print(f"\nProcessing file: {pdf_file}")
 
-        # Открываем PDF
-        doc = fitz.open(pdf_file)
-        total_pages = len(doc)
-
-        print(f"Оригинальный PDF содержит {total_pages} страниц.")
-
-        while True:
-            try:
-                if total_pages == 1:
-                    num_pages = 0
-                    break
-                num_pages = int(input(
-                    f"Сколько страниц оставить для '{os.path.basename(pdf_file)}'? (0 - оставить все, 1-{total_pages}): "))
-                if 0 <= num_pages <= total_pages:
-                    break
-                else:
-                    print("Ошибка: число вне диапазона.")
-            except ValueError:
-                print("Ошибка: введите целое число.")
-
-        image_data = []
-        if num_pages == 0:
-            print("Используется оригинальный PDF без изменений.")
-            for page in doc:
-                pix = page.get_pixmap()
-                img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                img_byte_arr = io.BytesIO()
-                img.save(img_byte_arr, format='PNG')
-                img_byte_arr = img_byte_arr.getvalue()
-                image_data.append(img_byte_arr)
-        else:
-            for page_num in range(num_pages):
-                page = doc.load_page(page_num)
-                pix = page.get_pixmap()
-                img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                img_byte_arr = io.BytesIO()
-                img.save(img_byte_arr, format='PNG')
-                img_byte_arr = img_byte_arr.getvalue()
-                image_data.append(img_byte_arr)
-
-        doc.close()
-
-        analysis_result = analyze_invoice(image_data, client)
-        #print("\nРезультат анализа:")
-        #print(analysis_result)
-
-        extracted_data = extract_data_from_analysis(analysis_result)
-
         base_name = os.path.splitext(os.path.basename(pdf_file))[0] # Use pdf_file basename
         output_file = f"{base_name}.xlsx"
-        if os.path.isdir(input_path): # if input was directory, output to same directory
-            output_file = os.path.join(input_path, output_file)
-
-        write_data_to_excel(extracted_data, output_file)
-
-        if pdf_files.index(pdf_file) < len(pdf_files) - 1: # Delay if not the last file
-            print("\nWaiting 10 seconds before processing the next file...")
-            time.sleep(10)
+        if os.path.isdir(input_path): # if input was directory, output next to the PDF
+            output_file = os.path.join(os.path.dirname(pdf_file), output_file)
+        if args.output == "register":
+            output_file = None
+
+        if journal:
+            record = journal.lookup(journal.content_hash(pdf_file))
+            if record and record["stage"] == "done":
+                # same content was finished before, possibly under another name
+                print(f"Уже обработан ранее ({record['path']}), пропускаем.")
+                if register and record["data"]:
+                    register.add(os.path.basename(pdf_file), record["data"])
+                if export and record["data"] and not record["exported"]:
+                    # its rows were still buffered when the previous run stopped
+                    export.add(pdf_file, record["data"])
+                if output_file and record["data"] and not os.path.exists(output_file):
+                    write_data_to_excel(record["data"], output_file, args.template)
+                continue
+            journal.start(pdf_file, output_file)
+            if record and record["result"] is not None and not args.refresh:
+                # the model answer survived the previous run, only the output is left to write
+                print("Продолжаем с сохраненного ответа модели.")
+                doc_metrics = metrics_log.document(pdf_file) if metrics_log else None
+                if doc_metrics:
+                    doc_metrics.parse_path = "journal"
+                submit(pdf_file, finish_invoice, pdf_file, record["result"], output_file, register, args.template,
+                       doc_metrics, journal, export)
+                continue
+
+        # "auto" is resolved by the render process, only "ask" needs the page count here
+        page_numbers = args.pages
+        if args.pages == "ask":
+            # Открываем PDF
+            doc = fitz.open(pdf_file)
+            total_pages = len(doc)
+            doc.close()
+
+            print(f"Оригинальный PDF содержит {total_pages} страниц.")
+
+            while True:
+                try:
+                    if total_pages == 1:
+                        num_pages = 0
+                        break
+                    num_pages = int(input(
+                        f"Сколько страниц оставить для '{os.path.basename(pdf_file)}'? (0 - оставить все, 1-{total_pages}): "))
+                    if 0 <= num_pages <= total_pages:
+                        break
+                    else:
+                        print("Ошибка: число вне диапазона.")
+                except ValueError:
+                    print("Ошибка: введите целое число.")
+
+            if num_pages == 0:
+                print("Используется оригинальный PDF без изменений.")
+            page_numbers = str(num_pages)
+
+        if engine:
+            submit(pdf_file, process_document, pdf_file, engine, output_file, register, args.template,
+                   metrics_log.document(pdf_file) if metrics_log else None, journal, page_numbers, export)
+            continue
+
+        # bounded render queue: block on the oldest file before rendering further ahead
+        while len(rendering) >= max(1, args.prefetch):
+            hand_off()
+        rendering.append((pdf_file, output_file, render_pool.submit(
+            render_timed, pdf_file, page_numbers, profile, args.payload_stats, memory_cap, args.spool_dir,
+            not args.keep_all_pages)))
+        while rendering and rendering[0][2].done():
+            hand_off()
+
+    if not found:
+        print(f"Error: No PDF files found in '{input_path}'.")
+
+    while rendering:
+        hand_off()
+    flush_pack()
+    collect(wait(in_flight).done)
+    executor.shutdown()
+    render_pool.shutdown()
+    if register:
+        register.close()
+    if export:
+        export.close()
+    if journal:
+        journal.close()
+    if context:
+        context.close()
+    if engine:
+        engine.close()
+    if metrics_log:
+        metrics_log.print_summary()
 
     print("\nFinished processing all files.")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()